@@ -0,0 +1,85 @@
+__author__ = 'jssmith'
+
+'''
+Dark spectrum store for background correction of ruby spectra
+
+Dark spectra are averaged from frames taken with the laser blocked and kept per integration time,
+so the live display and SPE file processing subtract the detector background before fitting
+instead of leaving it to the linear background term of the fit.
+'''
+
+import numpy as np
+
+
+class DarkStore:
+    '''
+    Averaged dark spectra, keyed by integration time in ms.
+
+    Each dark is a read-only float64 array shaped like one frame, so it broadcasts over a
+    single spectrum, an (n, pixels) stack, or an SpeFile block of shape (n, x, y).
+    '''
+
+    def __init__(self):
+        self.darks = {}
+        self.counts = {}
+
+    @staticmethod
+    def _key(integration_time):
+        # integration times arrive as ints from the GUI and as floats (exp_sec * 1000) from files
+        return round(float(integration_time), 3)
+
+    def capture(self, integration_time, frames):
+        # average a stack of dark frames (first axis) and store it, replacing any earlier dark
+        frames = np.asarray(frames)
+        dark = frames.mean(axis=0, dtype=np.float64)
+        self._store(integration_time, dark, len(frames))
+        return dark
+
+    def capture_spe(self, spe):
+        # average every frame of a dark SpeFile, reading it block by block
+        total = None
+        for start, block in spe.iter_blocks():
+            block_sum = block.sum(axis=0, dtype=np.float64)
+            total = block_sum if total is None else total + block_sum
+        if total is None:
+            raise ValueError('%s has no frames' % spe.path)
+        dark = total / spe.header.NumFrames
+        self._store(spe.header.exp_sec * 1000, dark, spe.header.NumFrames)
+        return dark
+
+    def _store(self, integration_time, dark, count):
+        dark.flags.writeable = False
+        key = self._key(integration_time)
+        self.darks[key] = dark
+        self.counts[key] = count
+
+    def dark(self, integration_time):
+        # dark for this integration time, or None if none was captured
+        return self.darks.get(self._key(integration_time))
+
+    def subtract(self, frames, integration_time, out=None):
+        '''
+        Subtract the dark for integration_time from frames in one vectorized pass.
+
+        Float frames are corrected in place unless `out` is given.  Integer frames (raw SPE
+        data) cannot hold the result, so they are written to `out`, or to a new float64 array.
+        Frames are returned unchanged if there is no dark for integration_time.
+        '''
+        dark = self.dark(integration_time)
+        if dark is None:
+            return frames
+        if out is None:
+            out = frames if np.issubdtype(frames.dtype, np.floating) else np.empty(frames.shape)
+        return np.subtract(frames, dark, out=out)
+
+    def save(self, name):
+        # keep darks between sessions, one array per integration time
+        keys = sorted(self.darks)
+        arrays = {'dark_%i' % index: self.darks[key] for index, key in enumerate(keys)}
+        np.savez(name, integration_times=np.array(keys), counts=np.array([self.counts[key] for key in keys]),
+                 **arrays)
+
+    def load(self, name):
+        with np.load(name) as stored:
+            for index, (integration_time, count) in enumerate(zip(stored['integration_times'], stored['counts'])):
+                self._store(integration_time, np.array(stored['dark_%i' % index]), int(count))
@@ -0,0 +1,574 @@
+__author__ = 'jssmith'
+
+'''
+Peak models and fitting routines for ruby fluorescence spectra
+
+Nothing here imports Qt or the spectrometer drivers, so the same fitting code runs in the GUI
+fit thread, in scripts, and in worker processes for batch fitting of SPE files.  scipy is only
+imported by the first curve_fit fit, so importing this module stays cheap.
+'''
+
+import numpy as np
+from math import pi, sqrt
+from concurrent.futures import ProcessPoolExecutor
+
+
+# fit status codes, with the warning text shown by the GUI for each
+FIT_OK = 0
+FIT_TOO_WEAK = 1
+FIT_SATURATED = 2
+FIT_POOR = 3
+FIT_WARNINGS = {FIT_OK: '',
+                FIT_TOO_WEAK: 'Too weak',
+                FIT_SATURATED: 'Saturated',
+                FIT_POOR: 'Poor fit'}
+
+# constants shared by the pseudo-Voigt models, evaluated once at import
+LORENTZ_NORM = 2 / pi
+FOUR_LN2 = 4 * np.log(2)
+GAUSS_NORM = sqrt(FOUR_LN2) / sqrt(pi)
+
+
+def double_pseudo(x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg):
+    d1 = (x - c1) ** 2
+    d2 = (x - c2) ** 2
+    return a1 * (eta1 * LORENTZ_NORM * (w1 / (4 * d1 + w1 ** 2)) +
+                 (1 - eta1) * (GAUSS_NORM / w1) * np.exp(-(FOUR_LN2 / w1 ** 2) * d1)) + \
+           a2 * (eta2 * LORENTZ_NORM * (w2 / (4 * d2 + w2 ** 2)) +
+                 (1 - eta2) * (GAUSS_NORM / w2) * np.exp(-(FOUR_LN2 / w2 ** 2) * d2)) + \
+           m * x + bg
+
+
+def pseudo(x, a, c, eta, w, m, bg):
+    d = (x - c) ** 2
+    return a * (eta * LORENTZ_NORM * (w / (4 * d + w ** 2)) +
+                (1 - eta) * (GAUSS_NORM / w) * np.exp(-(FOUR_LN2 / w ** 2) * d)) + m * x + bg
+
+
+def double_moffat(x, a1, c1, w1, b1, a2, c2, w2, b2, m, bg):
+    return a1*((((x - c1)/w1)**2 + 1)**-b1) + \
+           a2*((((x - c2)/w2)**2 + 1)**-b2) + \
+           m*x + bg
+
+
+def moffat(x, a, c, w, b, m, bg):
+    return a*((((x - c)/w)**2 + 1)**-b) + m*x + bg
+
+
+def _pseudo_jac_rows(x, a, c, eta, w):
+    # partial derivatives of one pseudo-Voigt peak, stacked parameter-first so that every row is contiguous
+    d = x - c
+    d2 = d ** 2
+    denominator = 4 * d2 + w ** 2
+    lorentz = LORENTZ_NORM * (w / denominator)
+    gauss = (GAUSS_NORM / w) * np.exp(-(FOUR_LN2 / w ** 2) * d2)
+    d_lorentz_dc = 8 * LORENTZ_NORM * w * d / denominator ** 2
+    d_gauss_dc = gauss * 2 * FOUR_LN2 * d / w ** 2
+    d_lorentz_dw = LORENTZ_NORM * (4 * d2 - w ** 2) / denominator ** 2
+    d_gauss_dw = gauss * (2 * FOUR_LN2 * d2 / w ** 2 - 1) / w
+    rows = np.empty((4,) + np.broadcast(x, c, w).shape)
+    rows[0] = eta * lorentz + (1 - eta) * gauss
+    rows[1] = a * (eta * d_lorentz_dc + (1 - eta) * d_gauss_dc)
+    rows[2] = a * (lorentz - gauss)
+    rows[3] = a * (eta * d_lorentz_dw + (1 - eta) * d_gauss_dw)
+    return rows
+
+
+def pseudo_jac(x, a, c, eta, w, m, bg):
+    # closed-form partial derivatives of pseudo, last axis indexes the parameters
+    x = np.asarray(x, dtype=float)
+    rows = np.empty((6,) + x.shape)
+    rows[0:4] = _pseudo_jac_rows(x, a, c, eta, w)
+    rows[4] = x
+    rows[5] = 1.0
+    return np.moveaxis(rows, 0, -1)
+
+
+def double_pseudo_jac_rows(x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg):
+    # partial derivatives of double_pseudo with the parameter axis first, shape (10,) + x.shape
+    x = np.asarray(x, dtype=float)
+    rows = np.empty((10,) + np.broadcast(x, c1, c2).shape)
+    rows[0:4] = _pseudo_jac_rows(x, a1, c1, eta1, w1)
+    rows[4:8] = _pseudo_jac_rows(x, a2, c2, eta2, w2)
+    rows[8] = x
+    rows[9] = 1.0
+    return rows
+
+
+def double_pseudo_jac(x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg):
+    # closed-form partial derivatives of double_pseudo, last axis indexes the parameters
+    return np.moveaxis(double_pseudo_jac_rows(x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg), 0, -1)
+
+
+def moffat_jac(x, a, c, w, b, m, bg):
+    # closed-form partial derivatives of moffat, last axis indexes the parameters
+    x = np.asarray(x, dtype=float)
+    d = x - c
+    u = (d / w) ** 2 + 1
+    profile = u ** -b
+    jac = np.empty(x.shape + (6,))
+    jac[..., 0] = profile
+    jac[..., 1] = 2 * a * b * profile * d / (u * w ** 2)
+    jac[..., 2] = 2 * a * b * profile * d ** 2 / (u * w ** 3)
+    jac[..., 3] = -a * profile * np.log(u)
+    jac[..., 4] = x
+    jac[..., 5] = 1.0
+    return jac
+
+
+def double_moffat_jac(x, a1, c1, w1, b1, a2, c2, w2, b2, m, bg):
+    # linear background columns are shared, so only take them once
+    jac = np.empty(np.shape(x) + (10,))
+    jac[..., 0:4] = moffat_jac(x, a1, c1, w1, b1, m, bg)[..., 0:4]
+    jac[..., 4:10] = moffat_jac(x, a2, c2, w2, b2, m, bg)
+    return jac
+
+
+class PseudoVoigtKernel:
+    '''
+    Buffered evaluation of pseudo and double_pseudo, and their Jacobians, for repeated fitting.
+
+    Work arrays are allocated once per ROI length and reused on every call, and the shared
+    (x - c)**2 term feeds both the Lorentzian and Gaussian parts.  Arrays returned here belong
+    to the kernel and are overwritten by the next call, so copy anything that must be kept
+    (plot data, for example).  Each thread should own its own kernel.
+    '''
+
+    def __init__(self):
+        self._buffers = {}
+
+    def _get_buffers(self, n):
+        buffers = self._buffers.get(n)
+        if buffers is None:
+            # per peak: d, d**2, 4*d**2 + w**2, lorentzian, gaussian
+            buffers = {'work': np.empty((2, 5, n)),
+                       'scratch': np.empty(n),
+                       'model': np.empty(n),
+                       'jac': np.empty((6, n)),
+                       'double_jac': np.empty((10, n))}
+            self._buffers[n] = buffers
+        return buffers
+
+    @staticmethod
+    def _peak_parts(x, c, w, work):
+        d, d2, denominator, lorentz, gauss = work
+        np.subtract(x, c, out=d)
+        np.multiply(d, d, out=d2)
+        np.multiply(d2, 4.0, out=denominator)
+        denominator += w * w
+        np.divide(LORENTZ_NORM * w, denominator, out=lorentz)
+        np.multiply(d2, -FOUR_LN2 / (w * w), out=gauss)
+        np.exp(gauss, out=gauss)
+        gauss *= GAUSS_NORM / w
+
+    @staticmethod
+    def _add_peak(out, a, eta, work, scratch):
+        lorentz, gauss = work[3], work[4]
+        np.multiply(lorentz, a * eta, out=scratch)
+        out += scratch
+        np.multiply(gauss, a * (1 - eta), out=scratch)
+        out += scratch
+
+    @staticmethod
+    def _peak_jac(rows, a, eta, w, work, scratch):
+        d, d2, denominator, lorentz, gauss = work
+        # amplitude
+        np.multiply(lorentz, eta, out=rows[0])
+        np.multiply(gauss, 1 - eta, out=scratch)
+        rows[0] += scratch
+        # center
+        np.divide(lorentz, denominator, out=scratch)
+        scratch *= 8 * eta
+        np.multiply(gauss, (1 - eta) * 2 * FOUR_LN2 / (w * w), out=rows[1])
+        rows[1] += scratch
+        rows[1] *= d
+        rows[1] *= a
+        # mixing
+        np.subtract(lorentz, gauss, out=rows[2])
+        rows[2] *= a
+        # width
+        np.divide(2 * w * w, denominator, out=scratch)
+        np.subtract(1.0, scratch, out=scratch)
+        scratch *= lorentz
+        scratch *= eta / w
+        np.multiply(d2, 2 * FOUR_LN2 / (w * w), out=rows[3])
+        rows[3] -= 1.0
+        rows[3] *= gauss
+        rows[3] *= (1 - eta) / w
+        rows[3] += scratch
+        rows[3] *= a
+
+    def pseudo(self, x, a, c, eta, w, m, bg):
+        buffers = self._get_buffers(len(x))
+        out, work, scratch = buffers['model'], buffers['work'][0], buffers['scratch']
+        np.multiply(x, m, out=out)
+        out += bg
+        self._peak_parts(x, c, w, work)
+        self._add_peak(out, a, eta, work, scratch)
+        return out
+
+    def double_pseudo(self, x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg):
+        buffers = self._get_buffers(len(x))
+        out, work, scratch = buffers['model'], buffers['work'], buffers['scratch']
+        np.multiply(x, m, out=out)
+        out += bg
+        self._peak_parts(x, c1, w1, work[0])
+        self._add_peak(out, a1, eta1, work[0], scratch)
+        self._peak_parts(x, c2, w2, work[1])
+        self._add_peak(out, a2, eta2, work[1], scratch)
+        return out
+
+    def double_pseudo_components(self, x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg, out=None):
+        # rows: the full model, each peak on the background, and the background, all in one pass
+        # out is (4, len(x)) and is filled in place, unlike the other results it belongs to the caller
+        buffers = self._get_buffers(len(x))
+        work, scratch = buffers['work'], buffers['scratch']
+        if out is None:
+            out = np.empty((4, len(x)))
+        np.multiply(x, m, out=out[3])
+        out[3] += bg
+        out[1] = out[3]
+        self._peak_parts(x, c1, w1, work[0])
+        self._add_peak(out[1], a1, eta1, work[0], scratch)
+        out[2] = out[3]
+        self._peak_parts(x, c2, w2, work[1])
+        self._add_peak(out[2], a2, eta2, work[1], scratch)
+        np.add(out[1], out[2], out=out[0])
+        out[0] -= out[3]
+        return out
+
+    def pseudo_jac(self, x, a, c, eta, w, m, bg):
+        buffers = self._get_buffers(len(x))
+        jac, work, scratch = buffers['jac'], buffers['work'][0], buffers['scratch']
+        self._peak_parts(x, c, w, work)
+        self._peak_jac(jac[0:4], a, eta, w, work, scratch)
+        jac[4] = x
+        jac[5] = 1.0
+        # rows are contiguous per parameter, the transpose is the (roi, parameter) layout curve_fit expects
+        return jac.T
+
+    def double_pseudo_jac(self, x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg):
+        buffers = self._get_buffers(len(x))
+        jac, work, scratch = buffers['double_jac'], buffers['work'], buffers['scratch']
+        self._peak_parts(x, c1, w1, work[0])
+        self._peak_jac(jac[0:4], a1, eta1, w1, work[0], scratch)
+        self._peak_parts(x, c2, w2, work[1])
+        self._peak_jac(jac[4:8], a2, eta2, w2, work[1], scratch)
+        jac[8] = x
+        jac[9] = 1.0
+        return jac.T
+
+
+def ruby_pressure(lambda_r1, lambda_0=694.260, alpha=1870, beta=10.69):
+    # IPPS-Ruby2020 by default, works on scalars or arrays of R1 positions
+    return alpha * ((1 / beta) * (((lambda_r1 / lambda_0) ** beta) - 1))
+
+
+def roi_bounds(ys, roi_min, roi_max):
+    # center the fitting ROI on the spectrum maximum, returns (start, stop) pixel indices
+    full_max_index = int(np.argmax(ys))
+    start = full_max_index - roi_min
+    stop = full_max_index + roi_max
+    # handle edge situations (for example, during background-only spectra)
+    if start < 0:
+        start = 0
+    if stop > len(ys) - 1:
+        stop = len(ys) - 1
+    return start, stop
+
+
+def initial_guess(xs, ys, start, stop):
+    # heuristic double_pseudo p0, R2 is placed 1.4 nm below R1 at half its height
+    xs_roi = xs[start:stop]
+    ys_roi = ys[start:stop]
+    roi_max_index = np.argmax(ys_roi)
+    # start with approximate linear background (using full spectrum)
+    slope = (ys[-1] - ys[0]) / (xs[-1] - xs[0])
+    intercept = ys[0] - slope * xs[0]
+    # obtain initial guesses for fitting parameters using ROI array (area approximated by height)
+    r1_pos = xs_roi[roi_max_index]
+    r2_pos = r1_pos - 1.4
+    r1_height = ys_roi[roi_max_index] - (slope * r1_pos + intercept)
+    r2_height = r1_height / 2.0
+    return [r2_height, r2_pos, 0.5, 1.0, r1_height, r1_pos, 0.5, 1.0, slope, intercept]
+
+
+def saturated(ys, max_intensity, start=0, stop=None):
+    # True if any of ys[start:stop] is at the saturation level, max_intensity is in counts or,
+    # for dark-corrected spectra, per pixel (the saturation level less the dark)
+    if np.ndim(max_intensity):
+        max_intensity = max_intensity[start:stop]
+    return bool(np.any(ys[start:stop] > max_intensity - 1))
+
+
+def estimate_r1(xs, ys, threshold=0, max_intensity=np.inf):
+    '''
+    Non-iterative R1 position from a three-point interpolation around the spectrum maximum
+
+    Uses a Gaussian (log-parabola) vertex on the baseline-subtracted intensities, or a plain
+    parabola if any of the three points is not above the baseline.  Returns (status, lambda_r1)
+    with the same status codes as fit_spectrum; lambda_r1 is None unless status is FIT_OK.
+    '''
+    index = int(np.argmax(ys))
+    if index == 0 or index == len(ys) - 1:
+        return FIT_POOR, None
+    # same linear background estimate as initial_guess (using full spectrum)
+    slope = (ys[-1] - ys[0]) / (xs[-1] - xs[0])
+    intercept = ys[0] - slope * xs[0]
+    y_left, y_peak, y_right = ys[index - 1:index + 2] - (slope * xs[index - 1:index + 2] + intercept)
+    if y_peak < threshold:
+        return FIT_TOO_WEAK, None
+    if saturated(ys, max_intensity):
+        return FIT_SATURATED, None
+    if y_left > 0 and y_right > 0:
+        y_left, y_peak, y_right = np.log(y_left), np.log(y_peak), np.log(y_right)
+    curvature = y_left - 2 * y_peak + y_right
+    if not curvature < 0:
+        return FIT_POOR, None
+    # vertex offset in pixels, then convert using the local pixel spacing on that side
+    offset = 0.5 * (y_left - y_right) / curvature
+    if offset > 0:
+        lambda_r1 = xs[index] + offset * (xs[index + 1] - xs[index])
+    else:
+        lambda_r1 = xs[index] + offset * (xs[index] - xs[index - 1])
+    return FIT_OK, float(lambda_r1)
+
+
+def fit_spectrum(xs, ys, start, stop, threshold, max_intensity, kernel, previous_popt=None, tolerance=0.0,
+                 full_output=False):
+    '''
+    Fit double_pseudo to ys[start:stop] and return (status, popt), popt is None unless status is FIT_OK.
+
+    With full_output, (status, popt, r1_error) is returned, r1_error being the standard error of
+    the R1 position (nm) from the fit covariance, NaN unless status is FIT_OK or if the covariance
+    could not be estimated.
+
+    If previous_popt is given and its R1 center lies within tolerance (nm) of the new R1 estimate,
+    it is tried as the initial guess first, falling back to the heuristic guess if that fit fails.
+    '''
+    p0 = initial_guess(xs, ys, start, stop)
+    r1_height = p0[4]
+    # check r1_height is within range before fitting
+    if r1_height < threshold:
+        return (FIT_TOO_WEAK, None, np.nan) if full_output else (FIT_TOO_WEAK, None)
+    if saturated(ys, max_intensity, start, stop):
+        return (FIT_SATURATED, None, np.nan) if full_output else (FIT_SATURATED, None)
+    if previous_popt is not None and abs(previous_popt[5] - p0[5]) < tolerance:
+        guesses = [previous_popt, p0]
+    else:
+        guesses = [p0]
+    # imported on first use, a no-op once scipy.optimize is loaded
+    from scipy.optimize import curve_fit
+    xs_roi = xs[start:stop]
+    ys_roi = ys[start:stop]
+    for guess in guesses:
+        try:
+            popt, pcov = curve_fit(kernel.double_pseudo, xs_roi, ys_roi, p0=guess, jac=kernel.double_pseudo_jac)
+        except RuntimeError:
+            continue
+        if full_output:
+            # curve_fit reports an infinite covariance when it cannot be estimated
+            r1_error = np.sqrt(pcov[5, 5]) if np.isfinite(pcov[5, 5]) and pcov[5, 5] >= 0 else np.nan
+            return FIT_OK, popt, float(r1_error)
+        return FIT_OK, popt
+    return (FIT_POOR, None, np.nan) if full_output else (FIT_POOR, None)
+
+
+def batch_initial_guess(xs, frames, roi_min, roi_max):
+    '''
+    Vectorized roi_bounds and initial_guess for an (n_frames, n_pixels) array
+
+    Every ROI is gathered into a fixed roi_min + roi_max window; pixels beyond the clipped ROI of
+    frames near the spectrum edges are flagged False in the returned mask.  Returns
+    (xs_roi, ys_roi, mask, p0), the first three (n_frames, roi_length) and p0 (n_frames, 10).
+    '''
+    num_frames, num_pixels = frames.shape
+    index, mask = _roi_index(frames, roi_min, roi_max)
+    xs_roi = xs[index]
+    ys_roi = np.take_along_axis(frames, index, axis=1)
+    roi_max_index = np.argmax(np.where(mask, ys_roi, -np.inf), axis=1)
+    rows = np.arange(num_frames)
+    # start with approximate linear background (using full spectrum)
+    slope = (frames[:, -1] - frames[:, 0]) / (xs[-1] - xs[0])
+    intercept = frames[:, 0] - slope * xs[0]
+    # obtain initial guesses for fitting parameters using ROI array (area approximated by height)
+    r1_pos = xs_roi[rows, roi_max_index]
+    r1_height = ys_roi[rows, roi_max_index] - (slope * r1_pos + intercept)
+    p0 = np.empty((num_frames, 10))
+    p0[:, 0] = r1_height / 2.0
+    p0[:, 1] = r1_pos - 1.4
+    p0[:, 2] = 0.5
+    p0[:, 3] = 1.0
+    p0[:, 4] = r1_height
+    p0[:, 5] = r1_pos
+    p0[:, 6] = 0.5
+    p0[:, 7] = 1.0
+    p0[:, 8] = slope
+    p0[:, 9] = intercept
+    return xs_roi, ys_roi, mask, p0
+
+
+def _roi_index(frames, roi_min, roi_max):
+    # pixel index of each frame's roi_min + roi_max window and the mask of pixels inside its clipped ROI
+    num_pixels = frames.shape[1]
+    full_max_index = np.argmax(frames, axis=1)
+    start = np.maximum(full_max_index - roi_min, 0)
+    stop = np.minimum(full_max_index + roi_max, num_pixels - 1)
+    index = start[:, None] + np.arange(roi_min + roi_max)
+    mask = index < stop[:, None]
+    return np.minimum(index, num_pixels - 1), mask
+
+
+def _batch_cost(xs_roi, ys_roi, mask, params):
+    residuals = (ys_roi - double_pseudo(xs_roi, *params.T[:, :, None])) * mask
+    return residuals, np.einsum('nl,nl->n', residuals, residuals)
+
+
+def batch_levenberg_marquardt(xs_roi, ys_roi, mask, p0, max_iterations=200, ftol=1.49012e-08, xtol=1.49012e-08):
+    '''
+    Fit double_pseudo to many stacked ROIs at once with a NumPy-batched Levenberg-Marquardt solver
+
+    Residuals and Jacobians are built as (n, roi_length) and (n, roi_length, 10) arrays and each
+    iteration solves all 10x10 damped normal equations together.  Masked pixels carry no weight.
+    Spectra drop out of the iteration as they converge.  Returns (popt, converged) with popt
+    (n, 10) and converged a boolean array.
+    '''
+    params = np.array(p0, dtype=float)
+    num_frames = len(params)
+    damping = np.full(num_frames, 1e-3)
+    converged = np.zeros(num_frames, dtype=bool)
+    failed = np.zeros(num_frames, dtype=bool)
+    residuals, cost = _batch_cost(xs_roi, ys_roi, mask, params)
+    identity = np.eye(10)
+    for iteration in range(max_iterations):
+        active = np.flatnonzero(~(converged | failed))
+        if not active.size:
+            break
+        p = params[active]
+        rows = double_pseudo_jac_rows(xs_roi[active], *p.T[:, :, None])
+        rows *= mask[active]
+        jac_t = rows.transpose(1, 0, 2)
+        jtj = np.matmul(jac_t, jac_t.transpose(0, 2, 1))
+        jtr = np.matmul(jac_t, residuals[active][:, :, None])[:, :, 0]
+        # Marquardt scaling, with a floor so that empty columns cannot make the system singular
+        diagonal = np.diagonal(jtj, axis1=1, axis2=2)
+        diagonal = np.maximum(diagonal, 1e-12 * diagonal.max(axis=1, keepdims=True) + 1e-300)
+        damped = jtj + damping[active, None, None] * diagonal[:, :, None] * identity
+        step = np.linalg.solve(damped, jtr[:, :, None])[:, :, 0]
+        trial = p + step
+        trial_residuals, trial_cost = _batch_cost(xs_roi[active], ys_roi[active], mask[active], trial)
+        accepted = np.isfinite(trial_cost) & (trial_cost <= cost[active])
+        # accepted steps move the parameters and relax the damping, rejected steps raise it
+        moved = active[accepted]
+        small_cost_change = (cost[moved] - trial_cost[accepted]) <= ftol * cost[moved]
+        small_step = np.linalg.norm(step[accepted], axis=1) <= xtol * (np.linalg.norm(p[accepted], axis=1) + xtol)
+        params[moved] = trial[accepted]
+        residuals[moved] = trial_residuals[accepted]
+        cost[moved] = trial_cost[accepted]
+        damping[moved] = np.maximum(damping[moved] / 10, 1e-12)
+        converged[moved] = small_cost_change | small_step
+        rejected = active[~accepted]
+        damping[rejected] *= 10
+        failed[rejected] = damping[rejected] > 1e12
+    converged &= np.all(np.isfinite(params), axis=1)
+    return params, converged
+
+
+def _fit_chunk_batched(xs, frames, roi_min, roi_max, threshold, max_intensity):
+    # vectorized counterpart of the curve_fit loop in _fit_chunk, needs frames of equal length
+    frames = np.asarray(frames, dtype=float).reshape(len(frames), -1)
+    xs_roi, ys_roi, mask, p0 = batch_initial_guess(xs, frames, roi_min, roi_max)
+    status = np.full(len(frames), FIT_OK, dtype=np.int8)
+    # check r1_height is within range before fitting
+    if np.ndim(max_intensity):
+        # per-pixel saturation level of dark-corrected frames, gathered like the ROI
+        max_intensity = np.asarray(max_intensity)[_roi_index(frames, roi_min, roi_max)[0]]
+    over = np.where(mask, ys_roi > max_intensity - 1, False)
+    status[np.any(over, axis=1)] = FIT_SATURATED
+    status[p0[:, 4] < threshold] = FIT_TOO_WEAK
+    popts = np.full((len(frames), 10), np.nan)
+    fit = np.flatnonzero(status == FIT_OK)
+    popt, converged = batch_levenberg_marquardt(xs_roi[fit], ys_roi[fit], mask[fit], p0[fit])
+    popts[fit[converged]] = popt[converged]
+    status[fit[~converged]] = FIT_POOR
+    return popts, status
+
+
+def _fit_chunk(args):
+    # worker for fit_frames, fits one block of consecutive frames and warm starts along the block
+    xs, frames, roi_min, roi_max, threshold, max_intensity, tolerance, method, dark = args
+    if dark is not None:
+        # one vectorized pass over the whole chunk, corrected counts saturate at max_intensity - dark
+        frames = np.subtract(np.asarray(frames).reshape(len(frames), -1), dark, dtype=float)
+        max_intensity = max_intensity - dark
+    if method == 'batch':
+        return _fit_chunk_batched(xs, frames, roi_min, roi_max, threshold, max_intensity)
+    kernel = PseudoVoigtKernel()
+    popts = np.full((len(frames), 10), np.nan)
+    status = np.empty(len(frames), dtype=np.int8)
+    popt = None
+    for index in range(len(frames)):
+        ys = np.asarray(frames[index], dtype=float).ravel()
+        start, stop = roi_bounds(ys, roi_min, roi_max)
+        status[index], popt = fit_spectrum(xs, ys, start, stop, threshold, max_intensity, kernel,
+                                           previous_popt=popt, tolerance=tolerance)
+        if popt is not None:
+            popts[index] = popt
+    return popts, status
+
+
+def fit_frames(frames, xs=None, roi_min=150, roi_max=150, threshold=1000, max_intensity=np.inf,
+               tolerance=0.5, lambda_0=694.260, alpha=1870, beta=10.69, workers=None, chunk_size=64,
+               method='curve_fit', dark=None):
+    '''
+    Fit every frame of a SpeFile, or of an (n_frames, n_pixels) array, and return a dict of arrays
+
+    Keys are 'r1', 'r2', 'r1_width', 'r2_width', 'pressure', 'status' (FIT_* codes) and 'popt'
+    (n_frames x 10, NaN where the fit did not succeed).  Frames are split into chunks of
+    chunk_size that are fitted in a process pool of `workers` processes (default: one per CPU),
+    workers=1 fits in this process.  On Windows the calling script needs the usual
+    if __name__ == '__main__' guard for the process pool.
+
+    method='curve_fit' fits frame by frame, warm starting from the previous frame in the chunk.
+    method='batch' fits each chunk at once with batch_levenberg_marquardt, which avoids the
+    per-call curve_fit overhead (use larger chunks, e.g. 256, to get the benefit).
+
+    dark, e.g. from RubyDark.DarkStore, is subtracted from every frame before fitting.  Saturation
+    is still judged on the raw counts, by comparing the corrected counts with max_intensity - dark.
+    '''
+    if method not in ('curve_fit', 'batch'):
+        raise ValueError('unknown fitting method %s' % method)
+    if hasattr(frames, 'header'):
+        # SpeFile, one spectrum per frame, mapped so that each chunk is only read when it is fitted
+        if xs is None:
+            xs = frames.xaxis
+        frames = frames.mapped_data.reshape(frames.header.NumFrames, -1)
+    if xs is None:
+        raise ValueError('xs is required unless frames is a SpeFile')
+    xs = np.asarray(xs, dtype=float)
+    num_frames = len(frames)
+    if num_frames and np.size(frames[0]) != len(xs):
+        raise ValueError('frames have %i pixels but xs has %i' % (np.size(frames[0]), len(xs)))
+    if dark is not None:
+        dark = np.asarray(dark, dtype=float).ravel()
+    chunks = [(xs, frames[start:start + chunk_size], roi_min, roi_max, threshold, max_intensity, tolerance, method,
+               dark)
+              for start in range(0, num_frames, chunk_size)]
+    if workers == 1 or len(chunks) < 2:
+        results = [_fit_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_fit_chunk, chunks))
+    if results:
+        popt = np.concatenate([each[0] for each in results])
+        status = np.concatenate([each[1] for each in results])
+    else:
+        popt = np.empty((0, 10))
+        status = np.empty(0, dtype=np.int8)
+    return {'r1': popt[:, 5],
+            'r2': popt[:, 1],
+            'r1_width': popt[:, 7],
+            'r2_width': popt[:, 3],
+            'pressure': ruby_pressure(popt[:, 5], lambda_0, alpha, beta),
+            'status': status,
+            'popt': popt}
@@ -0,0 +1,184 @@
+__author__ = 'jssmith'
+
+'''
+Bounded pressure-versus-time history of fit results, for strip charts of pressure ramps
+
+Fit results go into a fixed-size circular array.  Coarser levels keep the minimum and maximum
+pressure of each bucket of `factor` entries of the level below, in arrays of the same size, so
+hours or days of a ramp stay in a few MB and any time span is drawn from a few thousand points.
+'''
+
+import numpy as np
+from RubyPlot import peak_indices
+
+
+# one fit result, status is the fit status code from RubyFit and r1_error the standard error of R1 (nm)
+HISTORY_DTYPE = np.dtype([('timestamp', '<f8'),
+                          ('lambda_r1', '<f8'),
+                          ('pressure', '<f8'),
+                          ('temperature', '<f8'),
+                          ('status', '<i4'),
+                          ('r1_error', '<f8')])
+# time span of a bucket and the time and value of its lowest and highest pressure
+BUCKET_DTYPE = np.dtype([('start', '<f8'),
+                         ('end', '<f8'),
+                         ('time_min', '<f8'),
+                         ('pressure_min', '<f8'),
+                         ('time_max', '<f8'),
+                         ('pressure_max', '<f8')])
+
+
+def _chronological(ring, count):
+    # entries of a circular array, oldest first
+    capacity = len(ring)
+    if count <= capacity:
+        return ring[:count]
+    split = count % capacity
+    return np.concatenate((ring[split:], ring[:split]))
+
+
+def _oldest(ring, count):
+    # the oldest entry still held by a circular array
+    return ring[count % len(ring) if count > len(ring) else 0]
+
+
+def _bucket_points(buckets):
+    # times and pressures of the min and max points of each bucket, in the order they occurred
+    points = np.empty((len(buckets), 2, 2))
+    points[:, 0, 0], points[:, 0, 1] = buckets['time_min'], buckets['pressure_min']
+    points[:, 1, 0], points[:, 1, 1] = buckets['time_max'], buckets['pressure_max']
+    swap = buckets['time_max'] < buckets['time_min']
+    points[swap] = points[swap, ::-1]
+    points = points.reshape(-1, 2)
+    return points[:, 0], points[:, 1]
+
+
+class PressureHistory:
+    '''
+    Fit results over time at several resolutions, in fixed memory.
+
+    Level 0 holds the newest `capacity` results.  Level n > 0 holds the newest `capacity`
+    buckets of factor**n results each, so it reaches capacity * factor**n results back.  Failed
+    fits are kept with a NaN pressure and are left out of the buckets and of series().
+    '''
+
+    def __init__(self, capacity=16384, levels=4, factor=16):
+        self.capacity = capacity
+        self.factor = factor
+        self.records = np.zeros(capacity, dtype=HISTORY_DTYPE)
+        self.count = 0
+        # levels 1 and up: completed buckets, how many were ever completed, and the bucket being filled
+        self.buckets = [np.zeros(capacity, dtype=BUCKET_DTYPE) for level in range(levels - 1)]
+        self.bucket_counts = [0] * (levels - 1)
+        self.partial = [None] * (levels - 1)
+        self.merged = [0] * (levels - 1)
+        # per level, (entries held, times, pressures) of its valid points, rebuilt only once it changes
+        self._points = [None] * levels
+
+    def __len__(self):
+        return self.count
+
+    def add(self, timestamp, lambda_r1, pressure, temperature, status, r1_error=np.nan):
+        self.records[self.count % self.capacity] = (timestamp, lambda_r1, pressure, temperature, status, r1_error)
+        self.count += 1
+        bucket = [timestamp, timestamp, timestamp, pressure, timestamp, pressure]
+        level = 0
+        while bucket is not None and level < len(self.buckets):
+            bucket = self._merge(level, bucket)
+            level += 1
+
+    def _merge(self, level, bucket):
+        # merge into the bucket being filled at this level, returning it once it is complete
+        partial = self.partial[level]
+        if partial is None:
+            partial = list(bucket)
+        else:
+            partial[1] = bucket[1]
+            # a NaN pressure never compares, so it is replaced by the first real one
+            if bucket[3] < partial[3] or partial[3] != partial[3]:
+                partial[2:4] = bucket[2:4]
+            if bucket[5] > partial[5] or partial[5] != partial[5]:
+                partial[4:6] = bucket[4:6]
+        self.merged[level] += 1
+        if self.merged[level] < self.factor:
+            self.partial[level] = partial
+            return None
+        self.buckets[level][self.bucket_counts[level] % self.capacity] = tuple(partial)
+        self.bucket_counts[level] += 1
+        self.partial[level] = None
+        self.merged[level] = 0
+        return partial
+
+    def clear(self):
+        self.count = 0
+        self.bucket_counts = [0] * len(self.buckets)
+        self.partial = [None] * len(self.buckets)
+        self.merged = [0] * len(self.buckets)
+        self._points = [None] * len(self._points)
+
+    def latest(self):
+        # the newest fit result, or None
+        if not self.count:
+            return None
+        return self.records[(self.count - 1) % self.capacity]
+
+    def span(self):
+        # (oldest, newest) time still held at any level, or None if empty
+        if not self.count:
+            return None
+        oldest = min(self._oldest_time(level) for level in range(len(self.buckets) + 1) if self._held(level))
+        return oldest, self.latest()['timestamp']
+
+    def _held(self, level):
+        # entries ever added to a level, it holds the newest `capacity` of them
+        return self.count if level == 0 else self.bucket_counts[level - 1]
+
+    def _oldest_time(self, level):
+        # oldest time still held at a level that is not empty
+        if level == 0:
+            return _oldest(self.records, self.count)['timestamp']
+        return _oldest(self.buckets[level - 1], self.bucket_counts[level - 1])['start']
+
+    def _level_series(self, level):
+        # every valid point of a level in time order, buckets as their min and max points, newest buckets still filling last
+        held = self._held(level)
+        if self._points[level] is None or self._points[level][0] != held:
+            if level == 0:
+                times = _chronological(self.records['timestamp'], held)
+                pressures = _chronological(self.records['pressure'], held)
+            else:
+                times, pressures = _bucket_points(_chronological(self.buckets[level - 1], held))
+            valid = pressures == pressures
+            self._points[level] = (held, times[valid], pressures[valid])
+        held, times, pressures = self._points[level]
+        partial = [tuple(each) for each in self.partial[level - 1::-1] if each is not None] if level else []
+        if partial:
+            partial_times, partial_pressures = _bucket_points(np.array(partial, dtype=BUCKET_DTYPE))
+            valid = partial_pressures == partial_pressures
+            times = np.concatenate((times, partial_times[valid]))
+            pressures = np.concatenate((pressures, partial_pressures[valid]))
+        return times, pressures
+
+    def series(self, t_min, t_max, columns):
+        '''
+        Times and pressures to draw for the span t_min to t_max, `columns` pixels wide.
+
+        The finest level that still reaches back to t_min is used, unless so many of its points
+        are in the span that the next level has at least two per column anyway.  The points are
+        then reduced to the min and max per column, with one point either side of the span so
+        the line reaches its edges.
+        '''
+        levels = len(self.buckets) + 1
+        for level in range(levels):
+            last = level + 1 == levels
+            # a level that no longer reaches back to t_min is skipped without building its points
+            if not last and self._held(level) > self.capacity and self._oldest_time(level) > t_min:
+                continue
+            times, pressures = self._level_series(level)
+            start = max(int(np.searchsorted(times, t_min, side='left')) - 1, 0)
+            stop = min(int(np.searchsorted(times, t_max, side='right')) + 1, len(times))
+            if last or stop - start <= 2 * columns * self.factor:
+                break
+        index = peak_indices(pressures[start:stop], columns)
+        index += start
+        return times[index], pressures[index]
@@ -0,0 +1,179 @@
+__author__ = 'jssmith'
+
+'''
+Append-only binary log of collected spectra and their fit results
+
+A log file is a fixed header followed by fixed-size records, one per spectrum, in the order the
+spectra were collected.  The header holds the wavelength axis, so a whole log reloads instantly
+with load_log(), which memory maps the records instead of reading them.
+
+Header (little-endian), padded with zeros to header_size(num_pixels) bytes:
+    magic        8 bytes, LOG_MAGIC
+    version      uint32
+    num_pixels   uint32
+    created      float64, unix time
+    wavelengths  num_pixels float64
+
+Records follow record_dtype(num_pixels).  Fit fields stay NaN, with status LOG_NOT_FITTED, for
+spectra that were never fitted, e.g. those skipped while the fit thread was busy.
+'''
+
+import numpy as np
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+
+LOG_MAGIC = b'RUBYSPEC'
+LOG_VERSION = 1
+LOG_NOT_FITTED = -1
+_PREAMBLE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('num_pixels', '<u4'), ('created', '<f8')])
+# rows of the sequence -> record lookup kept for late fit results
+_ROW_MEMORY = 4096
+
+
+def header_size(num_pixels):
+    # preamble plus wavelengths, rounded up to a whole number of 4 kB pages
+    size = _PREAMBLE.itemsize + 8 * num_pixels
+    return -(-size // 4096) * 4096
+
+
+def record_dtype(num_pixels):
+    # fit fields are contiguous so that a late fit result is patched with a single write
+    return np.dtype([('sequence', '<i8'),
+                     ('timestamp', '<f8'),
+                     ('integration_time', '<f8'),
+                     ('status', '<i4'),
+                     ('lambda_r1', '<f8'),
+                     ('pressure', '<f8'),
+                     ('temperature', '<f8'),
+                     ('lambda_0', '<f8'),
+                     ('popt', '<f8', (10,)),
+                     ('intensities', '<f4', (num_pixels,))])
+
+
+def _fit_dtype(num_pixels):
+    # the slice of a record written by SpectrumLog.add_fit
+    full = record_dtype(num_pixels)
+    names = ['status', 'lambda_r1', 'pressure', 'temperature', 'lambda_0', 'popt']
+    return np.dtype([(name, full.fields[name][0]) for name in names]), full.fields['status'][1]
+
+
+class SpectrumLog:
+    '''
+    Write spectra and fit results to a log file from a background thread.
+
+    add_spectrum and add_fit only pack a record and queue it, so they are cheap enough to call
+    from the collection and GUI threads.  The writer thread appends spectra at the end of the
+    file and patches fit results into the record of the spectrum they belong to.
+
+    Every record shares the wavelengths in the header, so add_spectrum skips frames on any other
+    axis, e.g. from a spectrometer attached after recording started, and returns False.
+    '''
+
+    def __init__(self, name, wavelengths):
+        wavelengths = np.asarray(wavelengths, dtype='<f8')
+        self.name = name
+        self.wavelengths = wavelengths.copy()
+        # the last axis found to match, so the same axis array is only compared once
+        self._matched = None
+        self.num_pixels = len(wavelengths)
+        self.dtype = record_dtype(self.num_pixels)
+        self.fit_dtype, self.fit_offset = _fit_dtype(self.num_pixels)
+        self.header_size = header_size(self.num_pixels)
+        self.records = 0
+        self._rows = OrderedDict()
+        self._file = open(name, 'wb')
+        header = np.zeros(self.header_size, dtype=np.uint8)
+        preamble = np.array([(LOG_MAGIC, LOG_VERSION, self.num_pixels, time.time())], dtype=_PREAMBLE)
+        header[:_PREAMBLE.itemsize] = preamble.view(np.uint8)
+        header[_PREAMBLE.itemsize:_PREAMBLE.itemsize + 8 * self.num_pixels] = wavelengths.view(np.uint8)
+        self._file.write(header.tobytes())
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write, name='spectrum log', daemon=True)
+        self._thread.start()
+
+    def matches(self, wavelengths):
+        # True if spectra on this wavelength axis can be added
+        if wavelengths is self._matched:
+            return True
+        if len(wavelengths) != self.num_pixels or not np.array_equal(wavelengths, self.wavelengths):
+            return False
+        self._matched = wavelengths
+        return True
+
+    def add_spectrum(self, frame):
+        # pack the frame now, the caller may reuse its intensities before the writer gets to it
+        if not self.matches(frame.xs):
+            return False
+        record = np.zeros(1, dtype=self.dtype)
+        record['sequence'] = frame.sequence
+        record['timestamp'] = frame.timestamp
+        record['integration_time'] = np.nan if frame.integration_time is None else frame.integration_time
+        record['status'] = LOG_NOT_FITTED
+        for name in ('lambda_r1', 'pressure', 'temperature', 'lambda_0', 'popt'):
+            record[name] = np.nan
+        record['intensities'] = frame.ys
+        self._queue.put(('spectrum', frame.sequence, record.tobytes()))
+        return True
+
+    def add_fit(self, sequence, status, popt, lambda_r1, pressure, temperature, lambda_0):
+        fit = np.zeros(1, dtype=self.fit_dtype)
+        fit['status'] = status
+        fit['lambda_r1'] = lambda_r1
+        fit['pressure'] = pressure
+        fit['temperature'] = temperature
+        fit['lambda_0'] = lambda_0
+        fit['popt'] = np.nan if popt is None else popt
+        self._queue.put(('fit', sequence, fit.tobytes()))
+
+    def close(self):
+        # write everything still queued, then close the file
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            kind, sequence, data = item
+            if kind == 'spectrum':
+                self._file.write(data)
+                self._rows[sequence] = self.records
+                self.records += 1
+                if len(self._rows) > _ROW_MEMORY:
+                    self._rows.popitem(last=False)
+            else:
+                row = self._rows.get(sequence)
+                if row is not None:
+                    self._file.seek(self.header_size + row * self.dtype.itemsize + self.fit_offset)
+                    self._file.write(data)
+                    self._file.seek(0, os.SEEK_END)
+            if self._queue.empty():
+                self._file.flush()
+
+
+def load_log(name):
+    '''
+    Open a spectrum log written by SpectrumLog.
+
+    Returns (wavelengths, records), with records a read-only np.memmap of record_dtype.  A record
+    left incomplete by a crash is ignored.
+    '''
+    preamble = np.fromfile(name, dtype=_PREAMBLE, count=1)
+    if not len(preamble) or preamble['magic'][0] != LOG_MAGIC:
+        raise ValueError('%s is not a spectrum log' % name)
+    if preamble['version'][0] > LOG_VERSION:
+        raise ValueError('%s was written by a newer version (%i)' % (name, preamble['version'][0]))
+    num_pixels = int(preamble['num_pixels'][0])
+    wavelengths = np.fromfile(name, dtype='<f8', count=num_pixels, offset=_PREAMBLE.itemsize)
+    offset = header_size(num_pixels)
+    dtype = record_dtype(num_pixels)
+    count = (os.path.getsize(name) - offset) // dtype.itemsize
+    if count <= 0:
+        return wavelengths, np.zeros(0, dtype=dtype)
+    return wavelengths, np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=(count,))
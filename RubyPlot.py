@@ -0,0 +1,104 @@
+__author__ = 'jssmith'
+
+'''
+Viewport-aware decimation of spectra for display
+
+A spectrum has more pixels than the plot has screen columns once it is zoomed out, and only part
+of it is on screen once zoomed in.  ViewportDecimator finds the visible pixels with a binary search
+on the wavelength axis and reduces them to the minimum and maximum of each screen column, so the
+plot draws a few hundred points per frame without losing narrow peaks.
+'''
+
+import numpy as np
+
+
+class ViewportDecimator:
+    '''
+    Visible, peak-preserving subsets of spectra on one wavelength axis.
+
+    The axis is indexed once, by set_axis(), and reindexed only when a different axis array is
+    given.  Axes from spectrometers increase with pixel number; any other order is handled through
+    a sorting permutation.
+    '''
+
+    def __init__(self):
+        self.xs = None
+        self.sorted_xs = None
+        # permutation from sorted order to pixel order, None when the axis is already increasing
+        self.order = None
+
+    def set_axis(self, xs):
+        if xs is self.xs:
+            return
+        self.xs = xs
+        if len(xs) < 2 or np.all(xs[1:] > xs[:-1]):
+            self.order = None
+            self.sorted_xs = xs
+        else:
+            self.order = np.argsort(xs, kind='stable')
+            self.sorted_xs = xs[self.order]
+
+    def inside(self, x_min, x_max):
+        # sorted index range of the pixels in [x_min, x_max], empty if there are none
+        start = int(np.searchsorted(self.sorted_xs, x_min, side='left'))
+        stop = int(np.searchsorted(self.sorted_xs, x_max, side='right'))
+        return start, stop
+
+    def bounds(self, x_min, x_max):
+        # inside() plus one pixel either side, drawn so that the line reaches the edges of the view
+        start, stop = self.inside(x_min, x_max)
+        return max(start - 1, 0), min(stop + 1, len(self.sorted_xs))
+
+    def _sorted(self, ys, start, stop):
+        if self.order is None:
+            return ys[start:stop]
+        return ys[self.order[start:stop]]
+
+    def extrema(self, ys, x_min, x_max):
+        # (min, max) of ys between x_min and x_max, or None if no pixel is in range
+        start, stop = self.inside(x_min, x_max)
+        if stop <= start:
+            return None
+        visible = self._sorted(ys, start, stop)
+        return visible.min(), visible.max()
+
+    def decimate(self, ys, x_min, x_max, columns):
+        # wavelengths and intensities to draw for the view from x_min to x_max, `columns` pixels wide
+        start, stop = self.bounds(x_min, x_max)
+        index = peak_indices(self._sorted(ys, start, stop), columns)
+        index += start
+        if self.order is not None:
+            index = self.order[index]
+        return self.xs[index], ys[index]
+
+
+def peak_indices(ys, columns):
+    '''
+    Indices of the points of ys to draw across `columns` screen columns.
+
+    ys of more than two points per column are split into `columns` buckets and each bucket is
+    replaced by its minimum and maximum, in the order they occur, so the line does not double
+    back.  The first and last points are always kept, so the line spans all of ys.  Shorter ys
+    are kept whole.
+    '''
+    count = len(ys)
+    columns = max(int(columns), 1)
+    if count <= 2 * columns:
+        return np.arange(count)
+    size = count // columns
+    buckets = count // size
+    used = buckets * size
+    blocks = np.asarray(ys[:used]).reshape(buckets, size)
+    pairs = np.empty((buckets, 2), dtype=np.intp)
+    pairs[:, 0] = blocks.argmin(axis=1)
+    pairs[:, 1] = blocks.argmax(axis=1)
+    pairs.sort(axis=1)
+    pairs += np.arange(0, used, size)[:, None]
+    index = [pairs.ravel()]
+    if pairs[0, 0] != 0:
+        index.insert(0, [0])
+    if used < count:
+        index.append(np.arange(used, count))
+    elif pairs[-1, 1] != count - 1:
+        index.append([count - 1])
+    return np.concatenate(index)
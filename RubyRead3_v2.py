@@ -8,26 +8,53 @@ hiddenimports=['six', 'scipy.spatial.transform._rotation_groups'],
 as copied from the .spec file
 '''
 
-# import necessary modules
+# import necessary modules, heavy ones (scipy.optimize, seabreeze, pyepics) load on first use
+import time
+LAUNCH_TIME = time.perf_counter()
 import sys
 from PyQt5 import QtWidgets as qtw
 from PyQt5 import QtCore as qtc
 from PyQt5 import QtGui as qtg
 import pyqtgraph as pg
-from pyqtgraph.GraphicsScene import exportDialog
-import seabreeze.spectrometers as sb
 import numpy as np
-from scipy.optimize import curve_fit
-from math import pi, sqrt
-from epics import PV
-import time
 import os
+import itertools
+import threading
+import argparse
+import importlib
+from RubyFit import PseudoVoigtKernel, roi_bounds, fit_spectrum, estimate_r1, \
+    FIT_OK, FIT_WARNINGS
+from RubyLog import SpectrumLog, LOG_NOT_FITTED
+from RubyDark import DarkStore
+from RubySpec import Acquisition, SimulatedSpectrometer, ReplaySpectrometer
+from RubyPlot import ViewportDecimator
+from RubyHistory import PressureHistory
+
+
+# seabreeze.spectrometers once load_seabreeze() has imported it, and the errors it raises
+sb = None
+SPECTROMETER_ERRORS = ()
+
+# serial numbers of the spectrometers RubyRead will attach to
+APPROVED_SPECTROMETERS = ['HR+C0308',
+                          'HR+C0996',
+                          'HR+D1333',
+                          'HR+C2429',
+                          'HR+C0614',
+                          'HR+C2911',
+                          'HR+C1514',
+                          'HR+D2121',
+                          'HR+C1923',
+                          'HR+D0677',
+                          'FLMS18881',
+                          'FLMT06374']
 
 
 class MainWindow(qtw.QMainWindow):
 
     spectra_requested_signal = qtc.pyqtSignal(bool)
-    fit_requested_signal = qtc.pyqtSignal(bool)
+    watch_requested_signal = qtc.pyqtSignal(bool)
+    fit_requested_signal = qtc.pyqtSignal(object)
 
     def __init__(self):
         super().__init__()
@@ -58,6 +85,17 @@ class MainWindow(qtw.QMainWindow):
         self.save_data_action.setShortcut('Ctrl+S')
         self.save_data_action.triggered.connect(self.save_data)
 
+        self.record_log_action = qtw.QAction('Record spectra', self)
+        self.record_log_action.setShortcut('Ctrl+R')
+        self.record_log_action.setCheckable(True)
+        self.record_log_action.toggled.connect(self.toggle_spectrum_log)
+
+        self.save_recent_action = qtw.QAction('Save recent spectra', self)
+        self.save_recent_action.triggered.connect(self.save_recent_spectra)
+
+        self.clear_history_action = qtw.QAction('Clear pressure history', self)
+        self.clear_history_action.triggered.connect(self.clear_history)
+
         self.close_rubyread_action = qtw.QAction('Exit', self)
         self.close_rubyread_action.setShortcut('Ctrl+Q')
         self.close_rubyread_action.triggered.connect(self.closeEvent)
@@ -75,6 +113,9 @@ class MainWindow(qtw.QMainWindow):
         self.file_menu = self.main_menu.addMenu('File')
         self.file_menu.addAction(self.load_data_action)
         self.file_menu.addAction(self.save_data_action)
+        self.file_menu.addAction(self.record_log_action)
+        self.file_menu.addAction(self.save_recent_action)
+        self.file_menu.addAction(self.clear_history_action)
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.close_rubyread_action)
         self.options_menu = self.main_menu.addMenu('Options')
@@ -125,6 +166,13 @@ class MainWindow(qtw.QMainWindow):
         self.fit_warning_display.setAlignment(qtc.Qt.AlignCenter)
         self.fit_warning_display.setToolTip('Fit warning')
 
+        self.skipped_fits_display = qtw.QLabel('0')
+        self.skipped_fits_display.setFrameShape(qtw.QFrame.Panel)
+        self.skipped_fits_display.setFrameShadow(qtw.QFrame.Sunken)
+        self.skipped_fits_display.setMinimumWidth(40)
+        self.skipped_fits_display.setAlignment(qtc.Qt.AlignCenter)
+        self.skipped_fits_display.setToolTip('Spectra skipped because fitting was slower than collection')
+
         self.threshold_label = qtw.QLabel('Fit threshold')
         self.threshold_min_input = qtw.QSpinBox()
         self.threshold_min_input.setRange(0, 16000)
@@ -156,6 +204,7 @@ class MainWindow(qtw.QMainWindow):
         self.tb_layout.addWidget(self.fit_one_spec_btn)
         self.tb_layout.addWidget(self.fit_n_spec_btn)
         self.tb_layout.addWidget(self.fit_warning_display)
+        self.tb_layout.addWidget(self.skipped_fits_display)
         self.tb_layout.addSpacing(20)
 
         self.tb_layout.addWidget(self.threshold_label)
@@ -186,7 +235,7 @@ class MainWindow(qtw.QMainWindow):
         self.pw.setLabel('bottom', 'Wavelength', units='nm', **label_style)
 
         # create plot items (need to be added when necessary)
-        self.raw_data = pg.PlotDataItem(name='raw')
+        self.raw_data = SpectrumCurve(name='raw')
         self.fit_data = pg.PlotDataItem(name='fit')
         self.r1_data = pg.PlotDataItem(name='r1')
         self.r2_data = pg.PlotDataItem(name='r2')
@@ -208,17 +257,38 @@ class MainWindow(qtw.QMainWindow):
 
         # raw data is always visible, add rest when or as needed
         self.pw.addItem(self.raw_data)
+        # the raw curve only holds the part of the spectrum in view, redraw it when the view changes
+        vb.sigXRangeChanged.connect(self.raw_data.redraw)
+        vb.sigResized.connect(self.raw_data.redraw)
 
         # create signal for target pressure line
         self.vline_target.sigPositionChanged.connect(self.target_line_moved)
 
+        # fit curves and the fit line stay in the plot, hidden until a fit is shown
+        self.fit_overlay = FitOverlay(self.pw, self.fit_data, self.r1_data, self.r2_data, self.bg_data)
+        self.vline_press.setVisible(False)
+        self.pw.addItem(self.vline_press)
+
+        # pressure history strip chart, drawn at the resolution of the time span in view
+        self.history_pw = pg.PlotWidget(name='History', axisItems={'bottom': pg.DateAxisItem(orientation='bottom')})
+        self.history_pw.plotItem.getAxis('left').enableAutoSIPrefix(False)
+        self.history_pw.setLabel('left', 'Pressure', units='GPa', **label_style)
+        self.history_data = HistoryCurve(core.history, name='history')
+        self.history_data.setPen(color='y')
+        self.history_pw.addItem(self.history_data)
+        self.history_pw.getViewBox().sigXRangeChanged.connect(self.history_data.redraw)
+        self.history_pw.getViewBox().sigResized.connect(self.history_data.redraw)
+
         # ###LAYOUT MANAGEMENT###
         # make layout for plot window and control window and add to main window
         self.bottom_layout = qtw.QHBoxLayout()
         self.mw_layout.addLayout(self.bottom_layout)
 
-        # add plot widget to bottom layout
-        self.bottom_layout.addWidget(self.pw)
+        # add spectrum and history plots to bottom layout
+        self.plots_layout = qtw.QVBoxLayout()
+        self.plots_layout.addWidget(self.pw, 3)
+        self.plots_layout.addWidget(self.history_pw, 1)
+        self.bottom_layout.addLayout(self.plots_layout)
 
         '''
         Control Window
@@ -377,10 +447,10 @@ class MainWindow(qtw.QMainWindow):
         self.scale_y_btn_grp.addButton(self.fix_y_btn, 2)
 
         # connect plot control signals
-        self.show_curve_cbtn.clicked.connect(self.show_curve_cbtn_clicked)
-        self.show_r1r2_cbtn.clicked.connect(self.show_r1r2_cbtn_clicked)
-        self.show_bg_cbtn.clicked.connect(self.show_bg_cbtn_clicked)
-        self.show_fit_p_cbtn.clicked.connect(self.show_fit_p_cbtn_clicked)
+        self.show_curve_cbtn.toggled.connect(self.show_curve_cbtn_clicked)
+        self.show_r1r2_cbtn.toggled.connect(self.show_r1r2_cbtn_clicked)
+        self.show_bg_cbtn.toggled.connect(self.show_bg_cbtn_clicked)
+        self.show_fit_p_cbtn.toggled.connect(self.show_fit_p_cbtn_clicked)
         self.show_ref_p_cbtn.clicked.connect(self.show_ref_p_cbtn_clicked)
         self.show_target_p_cbtn.clicked.connect(self.show_target_p_cbtn_clicked)
         self.show_target_p_lambda.editingFinished.connect(self.show_target_p_lambda_changed)
@@ -712,10 +782,17 @@ class MainWindow(qtw.QMainWindow):
 
         ### background subtraction ###
         # make background subtraction widgets
-        self.fetch_bg_btn = qtw.QPushButton('Grab current spectrum')
+        self.fetch_bg_btn = qtw.QPushButton('Capture dark')
+        self.dark_frames_label = qtw.QLabel('Frames')
+        self.dark_frames_sbox = qtw.QSpinBox()
+        self.dark_frames_sbox.setRange(1, 100)
+        self.dark_frames_sbox.setValue(10)
+        self.dark_status_display = qtw.QLabel('None')
         self.subtract_bg_cbox = qtw.QCheckBox('Subtract background')
 
         # connect background subtraction signals
+        self.fetch_bg_btn.clicked.connect(self.capture_dark)
+        self.subtract_bg_cbox.stateChanged.connect(self.toggle_dark_subtraction)
 
         # add background subtraction widgets to fitting tab
         self.background_subtraction_gb = qtw.QGroupBox('Background subtraction')
@@ -723,6 +800,9 @@ class MainWindow(qtw.QMainWindow):
         self.background_subtraction_gb_layout = qtw.QHBoxLayout()
         self.background_subtraction_gb.setLayout(self.background_subtraction_gb_layout)
         self.background_subtraction_gb_layout.addWidget(self.fetch_bg_btn)
+        self.background_subtraction_gb_layout.addWidget(self.dark_frames_label)
+        self.background_subtraction_gb_layout.addWidget(self.dark_frames_sbox)
+        self.background_subtraction_gb_layout.addWidget(self.dark_status_display)
         self.background_subtraction_gb_layout.addWidget(self.subtract_bg_cbox)
         self.fitting_tab_layout.addSpacing(10)
 
@@ -746,6 +826,79 @@ class MainWindow(qtw.QMainWindow):
         self.fitting_model_gb.setLayout(self.fitting_model_gb_layout)
         self.fitting_model_gb_layout.addWidget(self.fit_moffat_btn)
         self.fitting_model_gb_layout.addWidget(self.fit_pseudovoigt_btn)
+        self.fitting_tab_layout.addSpacing(10)
+
+        ### warm start ###
+        # make warm start widgets
+        self.warm_start_cbox = qtw.QCheckBox('Seed from previous fit')
+        self.warm_start_cbox.setChecked(True)
+        self.warm_start_tolerance_label = qtw.QLabel('Tolerance (nm)')
+        self.warm_start_tolerance_sbox = qtw.QDoubleSpinBox()
+        self.warm_start_tolerance_sbox.setDecimals(2)
+        self.warm_start_tolerance_sbox.setRange(0.01, 5.00)
+        self.warm_start_tolerance_sbox.setValue(0.50)
+        self.warm_start_tolerance_sbox.setSingleStep(0.05)
+
+        # connect warm start signals
+        self.warm_start_cbox.stateChanged.connect(self.toggle_warm_start)
+        self.warm_start_tolerance_sbox.valueChanged.connect(self.set_warm_start_tolerance)
+
+        # add warm start widgets to fitting tab
+        self.warm_start_gb = qtw.QGroupBox('Warm start (continuous fitting)')
+        self.fitting_tab_layout.addWidget(self.warm_start_gb)
+        self.warm_start_gb_layout = qtw.QHBoxLayout()
+        self.warm_start_gb.setLayout(self.warm_start_gb_layout)
+        self.warm_start_gb_layout.addWidget(self.warm_start_cbox)
+        self.warm_start_gb_layout.addWidget(self.warm_start_tolerance_label)
+        self.warm_start_gb_layout.addWidget(self.warm_start_tolerance_sbox)
+        self.fitting_tab_layout.addSpacing(10)
+
+        ### live preview ###
+        # make live preview widgets
+        self.quick_estimate_cbox = qtw.QCheckBox('Fast R1 estimate between fits')
+        self.fit_interval_label = qtw.QLabel('Full fit every (s)')
+        self.fit_interval_sbox = qtw.QDoubleSpinBox()
+        self.fit_interval_sbox.setDecimals(1)
+        self.fit_interval_sbox.setRange(0.1, 60.0)
+        self.fit_interval_sbox.setValue(1.0)
+        self.fit_interval_sbox.setSingleStep(0.5)
+
+        # connect live preview signals
+        self.quick_estimate_cbox.stateChanged.connect(self.toggle_quick_estimate)
+        self.fit_interval_sbox.valueChanged.connect(self.set_fit_interval)
+
+        # add live preview widgets to fitting tab
+        self.live_preview_gb = qtw.QGroupBox('Live preview (continuous fitting)')
+        self.fitting_tab_layout.addWidget(self.live_preview_gb)
+        self.live_preview_gb_layout = qtw.QHBoxLayout()
+        self.live_preview_gb.setLayout(self.live_preview_gb_layout)
+        self.live_preview_gb_layout.addWidget(self.quick_estimate_cbox)
+        self.live_preview_gb_layout.addWidget(self.fit_interval_label)
+        self.live_preview_gb_layout.addWidget(self.fit_interval_sbox)
+        self.fitting_tab_layout.addSpacing(10)
+
+        ### display rate ###
+        # make display rate widgets
+        self.max_fps_label = qtw.QLabel('Max redraws per second')
+        self.max_fps_sbox = qtw.QSpinBox()
+        self.max_fps_sbox.setRange(1, 120)
+        self.max_fps_sbox.setValue(30)
+        self.max_fps_sbox.setToolTip('Continuous fits are requested on each redraw, so this also caps the fit rate')
+        self.frames_drawn_display = qtw.QLabel('Drawn 0 of 0 spectra')
+        self.frames_drawn_display.setToolTip('Spectra arriving faster than the display rate are not drawn, '
+                                             'the newest one is shown instead')
+
+        # connect display rate signals
+        self.max_fps_sbox.valueChanged.connect(self.set_max_fps)
+
+        # add display rate widgets to fitting tab
+        self.display_rate_gb = qtw.QGroupBox('Display rate')
+        self.fitting_tab_layout.addWidget(self.display_rate_gb)
+        self.display_rate_gb_layout = qtw.QHBoxLayout()
+        self.display_rate_gb.setLayout(self.display_rate_gb_layout)
+        self.display_rate_gb_layout.addWidget(self.max_fps_label)
+        self.display_rate_gb_layout.addWidget(self.max_fps_sbox)
+        self.display_rate_gb_layout.addWidget(self.frames_drawn_display)
 
         self.ow.addTab(self.fitting_tab, 'Fitting')
 
@@ -825,6 +978,7 @@ class MainWindow(qtw.QMainWindow):
         self.collect.moveToThread(self.collect_thread)
         self.collect_thread.start()
         self.collect.spectra_returned_signal.connect(self.data_set)
+        self.collect.collection_done_signal.connect(self.collection_done)
         self.spectra_requested_signal.connect(self.collect.collect_specs)
 
         # initialize fit thread
@@ -833,7 +987,37 @@ class MainWindow(qtw.QMainWindow):
         self.fit.moveToThread(self.fit_thread)
         self.fit_thread.start()
         self.fit.fit_returned_signal.connect(self.fit_set)
-        self.fit_requested_signal.connect(self.fit.fit_specs)
+
+        # only one fit is in flight at a time, requests arriving meanwhile collapse to the newest
+        self.fit_scheduler = FitScheduler()
+        self.fit_requested_signal.connect(self.fit_scheduler.request)
+        self.fit_scheduler.fit_dispatched_signal.connect(self.fit.fit_specs)
+        self.fit.fit_returned_signal.connect(self.fit_scheduler.fit_done)
+
+        # collected spectra are drawn at most core.max_fps times a second, always the newest one
+        self.display_limiter = DisplayLimiter()
+        self.display_limiter.draw_signal.connect(self.draw_newest)
+        # the pressure history likewise, however fast fits return
+        self.history_limiter = DisplayLimiter()
+        self.history_limiter.draw_signal.connect(self.history_data.redraw)
+
+        # look for spectrometers off the GUI thread, the window works as a data viewer meanwhile
+        self.watcher = DeviceWatcher()
+        self.watcher_thread = qtc.QThread()
+        self.watcher.moveToThread(self.watcher_thread)
+        self.watcher_thread.start()
+        self.watcher.device_connected_signal.connect(self.spectrometer_connected)
+        self.watcher.devices_found_signal.connect(self.choose_spectrometer)
+        self.watcher.device_rejected_signal.connect(self.spectrometer_rejected)
+        # unplugging is noticed by the watcher, or by whichever thread talks to the spectrometer first
+        self.watcher.device_disconnected_signal.connect(self.spectrometer_disconnected)
+        self.collect.spectrometer_lost_signal.connect(self.spectrometer_disconnected)
+        self.watch_requested_signal.connect(self.watcher.watch)
+        if core.spec is None:
+            self.statusBar().showMessage('No spectrometer, data viewing mode (looking for spectrometers)')
+            self.watch_requested_signal.emit(True)
+        else:
+            self.statusBar().showMessage('Spectrometer: %s' % core.spec.serial_number)
 
         self.temperature_pv = []
 
@@ -855,59 +1039,123 @@ class MainWindow(qtw.QMainWindow):
                                filling_values=1,
                                usecols=(0, 1),
                                unpack=True)
-        core.xs = xs
         print(len(xs))
-        core.ys = ys
+        core.xs = xs
+        core.set_frame(core.new_frame(ys, integration_time=None, store=False))
         update()
 
     def save_data(self):
+        from pyqtgraph.GraphicsScene import exportDialog
+        # export every pixel, not the decimated view
+        self.raw_data.draw_full()
         scene = self.raw_data.scene()
         self.dialog_window = exportDialog.ExportDialog(scene)
         self.dialog_window.show(self.raw_data)
 
+    def save_recent_spectra(self):
+        # write the spectra still held in the ring to a new log, recorded or not
+        if self.collect.go:
+            qtw.QMessageBox.warning(self, 'Unable to save recent spectra', 'You must stop continuous data collection before saving recent spectra')
+            return
+        if not len(core.ring):
+            qtw.QMessageBox.warning(self, 'Unable to save recent spectra', 'No spectra have been collected yet')
+            return
+        name, _ = qtw.QFileDialog.getSaveFileName(self, 'Save recent spectra to', filter='*.rubylog')
+        if not name:
+            return
+        log = SpectrumLog(name, core.ring.xs)
+        for frame in core.ring.frames():
+            log.add_spectrum(frame)
+        log.close()
+
+    def clear_history(self):
+        core.history.clear()
+        self.history_data.clear()
+
+    def toggle_spectrum_log(self, checked):
+        if checked:
+            name, _ = qtw.QFileDialog.getSaveFileName(self, 'Record spectra to', filter='*.rubylog')
+            if not name:
+                self.record_log_action.setChecked(False)
+                return
+            core.log = SpectrumLog(name, core.xs)
+        elif core.log is not None:
+            log, core.log = core.log, None
+            log.close()
+
+    def check_log_axis(self):
+        # the log skips spectra on another wavelength axis, stop recording rather than drop them silently
+        if core.log is not None and not core.log.matches(core.xs):
+            name = core.log.name
+            self.record_log_action.setChecked(False)
+            qtw.QMessageBox.warning(self, 'Recording stopped',
+                                    'The wavelength axis changed, recording to %s was stopped.\n'
+                                    'Use File > Record spectra to record to a new file.' % name)
+
+    def showEvent(self, event):
+        # catch up on spectra that arrived while the window was hidden
+        super().showEvent(event)
+        self.raw_data.redraw()
+        self.history_data.redraw()
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == qtc.QEvent.WindowStateChange and not self.isMinimized():
+            self.raw_data.redraw()
+            self.history_data.redraw()
+
     def closeEvent(self, *args, **kwargs):
+        if core.log is not None:
+            core.log.close()
         self.fit_thread.quit()
         self.fit_thread.wait()
         if self.collect.go:
             self.collect.go = False
         self.collect_thread.quit()
         self.collect_thread.wait()
+        self.watcher.stop()
+        self.watcher_thread.quit()
+        self.watcher_thread.wait()
+        core.detach()
         app.closeAllWindows()
         sys.exit()
 
     # class methods for custom tool bar
     def take_one_spectrum(self):
-        if not self.collect.go:
-            intensities = core.spec.intensities()
-            if self.average_spec_cbox.isChecked():
-                num = self.average_spec_sbox.value()
-                for each in range(num - 1):
-                    intensities += core.spec.intensities()
-                intensities = intensities / num
-            core.ys = intensities
+        if not self.collect.go and core.spec is not None:
+            try:
+                with core.device_lock:
+                    intensities = core.acquisition.spectrum()
+            except SPECTROMETER_ERRORS:
+                self.spectrometer_disconnected(core.spec.serial_number)
+                return
+            core.set_frame(core.new_frame(intensities))
+            self.check_log_axis()
             update()
 
     def take_n_spectra(self):
-        if not self.collect.go:
+        if core.spec is None:
+            self.take_n_spec_btn.setChecked(False)
+        elif not self.collect.go:
+            self.display_limiter.reset()
+            self.remaining_time_display.setStyleSheet('background-color: green; color: yellow')
             self.spectra_requested_signal.emit(True)
         else:
             self.collect.stop()
 
     def fit_one_spectrum(self):
         if not self.fit_n_spec_btn.isChecked():
-            self.fit_requested_signal.emit(True)
+            self.fit_requested_signal.emit(core.frame)
 
     def fit_n_spectra(self):
         if self.fit_n_spec_btn.isChecked():
-            if not self.show_curve_cbtn.isChecked():
-                self.show_curve_cbtn.click()
-            if not self.show_fit_p_cbtn.isChecked():
-                self.show_fit_p_cbtn.click()
+            self.fit_scheduler.skipped = 0
+            self.skipped_fits_display.setText('0')
+            self.show_curve_cbtn.setChecked(True)
+            self.show_fit_p_cbtn.setChecked(True)
         else:
-            if self.show_curve_cbtn.isChecked():
-                self.show_curve_cbtn.click()
-            if self.show_fit_p_cbtn.isChecked():
-                self.show_fit_p_cbtn.click()
+            self.show_curve_cbtn.setChecked(False)
+            self.show_fit_p_cbtn.setChecked(False)
 
     def set_threshold(self):
         core.threshold = self.threshold_min_input.value()
@@ -920,8 +1168,7 @@ class MainWindow(qtw.QMainWindow):
 
     # class methods for spectrum control
     def update_count_time(self):
-        count_time = int(self.count_time_input.text()) * 1000
-        core.spec.integration_time_micros(count_time)
+        core.set_integration_time(int(self.count_time_input.text()))
 
     def count_time_shortcut(self, direction):
         # quickly increase count time over common range
@@ -931,47 +1178,37 @@ class MainWindow(qtw.QMainWindow):
             for each in reversed(preset_times):
                 if int(each) < old_time:
                     self.count_time_input.setText(each)
-                    core.spec.integration_time_micros(int(each)*1000)
+                    core.set_integration_time(int(each))
                     break
         if direction == 'up':
             for each in preset_times:
                 if int(each) > old_time:
                     self.count_time_input.setText(each)
-                    core.spec.integration_time_micros(int(each)*1000)
+                    core.set_integration_time(int(each))
                     break
 
     def toggle_average(self):
         core.average = self.average_spec_cbox.isChecked()
+        if core.acquisition is not None:
+            core.acquisition.set_scans(core.num_average if core.average else 1)
 
     def set_num_average(self):
         core.num_average = self.average_spec_sbox.value()
+        if core.acquisition is not None:
+            core.acquisition.set_scans(core.num_average if core.average else 1)
 
     # class methods for plot control
     def show_curve_cbtn_clicked(self):
-        if self.show_curve_cbtn.isChecked():
-            self.pw.addItem(self.fit_data)
-        else:
-            self.pw.removeItem(self.fit_data)
+        self.fit_overlay.show([self.fit_data], self.show_curve_cbtn.isChecked())
 
     def show_r1r2_cbtn_clicked(self):
-        if self.show_r1r2_cbtn.isChecked():
-            self.pw.addItem(self.r1_data)
-            self.pw.addItem(self.r2_data)
-        else:
-            self.pw.removeItem(self.r1_data)
-            self.pw.removeItem(self.r2_data)
+        self.fit_overlay.show([self.r1_data, self.r2_data], self.show_r1r2_cbtn.isChecked())
 
     def show_bg_cbtn_clicked(self):
-        if self.show_bg_cbtn.isChecked():
-            self.pw.addItem(self.bg_data)
-        else:
-            self.pw.removeItem(self.bg_data)
+        self.fit_overlay.show([self.bg_data], self.show_bg_cbtn.isChecked())
 
     def show_fit_p_cbtn_clicked(self):
-        if self.show_fit_p_cbtn.isChecked():
-            self.pw.addItem(self.vline_press)
-        else:
-            self.pw.removeItem(self.vline_press)
+        self.vline_press.setVisible(self.show_fit_p_cbtn.isChecked())
 
     def show_ref_p_cbtn_clicked(self):
         if self.show_ref_p_cbtn.isChecked():
@@ -1150,6 +1387,45 @@ class MainWindow(qtw.QMainWindow):
         if end == 'max':
             core.roi_max = value
 
+    def capture_dark(self):
+        if core.spec is None:
+            qtw.QMessageBox.warning(self, 'Unable to capture dark', 'No spectrometer is connected')
+            return
+        if self.collect.go:
+            qtw.QMessageBox.warning(self, 'Unable to capture dark', 'You must stop continuous data collection before capturing a dark spectrum')
+            return
+        # block the laser first, the average is kept for the current integration time
+        num = self.dark_frames_sbox.value()
+        # sized by the spectrometer, core.xs may be the axis of a loaded file
+        frames = np.empty((num, core.num_pixels))
+        try:
+            with core.device_lock:
+                for each in range(num):
+                    frames[each] = core.spec.intensities()
+        except SPECTROMETER_ERRORS:
+            self.spectrometer_disconnected(core.spec.serial_number)
+            return
+        core.darks.capture(core.integration_time, frames)
+        self.dark_status_display.setText(', '.join('%g' % each for each in sorted(core.darks.darks)) + ' ms')
+
+    def toggle_dark_subtraction(self):
+        core.subtract_dark = self.subtract_bg_cbox.isChecked()
+
+    def toggle_warm_start(self):
+        core.warm_start = self.warm_start_cbox.isChecked()
+
+    def set_warm_start_tolerance(self, value):
+        core.warm_start_tolerance = value
+
+    def toggle_quick_estimate(self):
+        core.quick_estimate = self.quick_estimate_cbox.isChecked()
+
+    def set_fit_interval(self, value):
+        core.fit_interval = value
+
+    def set_max_fps(self, value):
+        core.max_fps = value
+
     # class methods for EPICS tab
     def initialize_epics(self):
         pv_list = ['None (disconnected)',
@@ -1176,6 +1452,8 @@ class MainWindow(qtw.QMainWindow):
             if trial_pv == '':
                 self.epics_custom_entry.setText('Enter your PV here')
             temperature_pv = str(self.epics_custom_entry.text())
+        # pyepics loads libca, so it is only imported once a PV is wanted
+        from epics import PV
         self.temperature_pv = PV(temperature_pv, callback=self.track_temperature_pv,
                                  auto_monitor=True, connection_callback=self.epics_disconnect,
                                  connection_timeout=1.0)
@@ -1203,133 +1481,152 @@ class MainWindow(qtw.QMainWindow):
             self.epics_drop.setCurrentIndex(0)
 
     # ###THREAD CALLBACK METHODS### #
-    def data_set(self, data_dict):
-        if int(data_dict['remaining_time']) == 0:
-            self.remaining_time_display.setStyleSheet('')
-            self.remaining_time_display.setText('Idle')
-            self.take_n_spec_btn.setChecked(False)
+    def spectrometer_connected(self, spec):
+        core.attach(spec)
+        self.statusBar().showMessage('Spectrometer: %s' % spec.serial_number)
+        self.check_log_axis()
+        update()
+        vb.autoRange()
+
+    def spectrometer_disconnected(self, serial_number):
+        # reported by the watcher and by whichever call failed first, only the first report counts
+        if core.spec is None or core.spec.serial_number != serial_number:
+            return
+        if self.collect.go:
+            self.collect.stop()
+        # the watcher returns from watching the old spectrometer before it takes the request below
+        self.watcher.stop()
+        core.detach()
+        self.statusBar().showMessage('Spectrometer %s disconnected, data viewing mode (looking for spectrometers)'
+                                     % serial_number)
+        self.watch_requested_signal.emit(True)
+
+    def choose_spectrometer(self, serial_numbers):
+        serial_number, ok = qtw.QInputDialog.getItem(self, 'Multiple Spectrometers',
+                                                     'Several spectrometers found, select one:',
+                                                     serial_numbers, 0, False)
+        if ok:
+            self.watcher.choice = serial_number
         else:
-            core.ys = data_dict['raw_y']
-            self.remaining_time_display.setStyleSheet('background-color: green; color: yellow')
-            remaining_time = str(int(data_dict['remaining_time']))
-            self.remaining_time_display.setText(remaining_time)
-            update()
+            self.statusBar().showMessage('No spectrometer selected, data viewing mode (disconnect all but one '
+                                         'spectrometer to attach it)')
+
+    def spectrometer_rejected(self, serial_number):
+        self.statusBar().showMessage('Spectrometer %s is not recognized. Contact HPCAT staff to add it to the list '
+                                     'of approved devices.' % serial_number)
+
+    def data_set(self):
+        # take the newest spectrum, any that arrived since the last call are skipped
+        data_dict, arrived = self.collect.take()
+        if data_dict is None:
+            return
+        core.set_frame(data_dict['frame'])
+        self.check_log_axis()
+        self.remaining_time_display.setText(str(int(data_dict['remaining_time'])))
+        self.display_limiter.frame_arrived(arrived)
+
+    def collection_done(self):
+        self.remaining_time_display.setStyleSheet('')
+        self.remaining_time_display.setText('Idle')
+        self.take_n_spec_btn.setChecked(False)
+
+    def draw_newest(self):
+        update()
+        self.frames_drawn_display.setText('Drawn %i of %i spectra' % (self.display_limiter.drawn,
+                                                                       self.display_limiter.acquired))
 
     def fit_set(self, fit_dict):
+        self.skipped_fits_display.setText(str(self.fit_scheduler.skipped))
         warning = fit_dict['warning']
         if not warning == '':
             self.fit_warning_display.setStyleSheet('background-color: red; color: yellow')
             fitted_list = [self.show_curve_cbtn, self.show_r1r2_cbtn, self.show_bg_cbtn]
             for each in fitted_list:
-                if each.isChecked():
-                    each.click()
+                each.setChecked(False)
         else:
             popt = fit_dict['popt']
+            # draw against the ROI of the frame that was actually fitted
+            core.xs_roi = fit_dict['xs_roi']
+            core.ys_roi = fit_dict['ys_roi']
             self.lambda_r1_display.setText('%.3f' % popt[5])
-            self.fit_data.setData(core.xs_roi, double_pseudo(core.xs_roi, *popt))
-            self.r1_data.setData(core.xs_roi, pseudo(core.xs_roi, popt[4], popt[5], popt[6], popt[7], popt[8], popt[9]))
-            self.r2_data.setData(core.xs_roi, pseudo(core.xs_roi, popt[0], popt[1], popt[2], popt[3], popt[8], popt[9]))
-            self.bg_data.setData(core.xs_roi, (popt[8] * core.xs_roi + popt[9]))
+            self.fit_overlay.set_fit(core.xs_roi, popt)
             # calculate pressure
             core.lambda_r1 = popt[5]
             calculate_pressure(core.lambda_r1)
             self.vline_press.setPos(popt[5])
-            if not self.show_curve_cbtn.isChecked():
-                self.show_curve_cbtn.click()
-            if not self.show_fit_p_cbtn.isChecked():
-                self.show_fit_p_cbtn.click()
+            self.show_curve_cbtn.setChecked(True)
+            self.show_fit_p_cbtn.setChecked(True)
             self.fit_warning_display.setStyleSheet('')
         self.fit_warning_display.setText(warning)
+        # patch the result into the recorded spectrum
+        if core.log is not None:
+            if warning == '':
+                core.log.add_fit(fit_dict['frame'].sequence, fit_dict['status'], fit_dict['popt'], core.lambda_r1,
+                                 core.pressure, self.temperature_input.value(), core.lambda_0_t_user)
+            else:
+                core.log.add_fit(fit_dict['frame'].sequence, fit_dict['status'], None, np.nan, np.nan,
+                                 self.temperature_input.value(), core.lambda_0_t_user)
+        # failed fits are kept in the history without a pressure
+        if warning == '':
+            core.history.add(fit_dict['frame'].timestamp, core.lambda_r1, core.pressure, self.temperature_input.value(),
+                             fit_dict['status'], fit_dict['r1_error'])
+        else:
+            core.history.add(fit_dict['frame'].timestamp, np.nan, np.nan, self.temperature_input.value(),
+                             fit_dict['status'])
+        self.history_limiter.frame_arrived()
 
 
 class CoreData:
-    def __init__(self):
-        # get spectrometer going
-        # list of approved spectrometers
-        spec_list = ['HR+C0308',
-                     'HR+C0996',
-                     'HR+D1333',
-                     'HR+C2429',
-                     'HR+C0614',
-                     'HR+C2911',
-                     'HR+C1514',
-                     'HR+D2121',
-                     'HR+C1923',
-                     'HR+D0677',
-                     'FLMS18881',
-                     'FLMT06374']
-        # look for and select among available spectrometers
-        index = -1
-        retries = 0
-        while index == -1:
-            devices = sb.list_devices()
-            num_devices = len(devices)
-            if num_devices == 1:
-                index = 0
-            elif num_devices == 0:
-                # Important to make the number of retry checks here
-                if retries > 2:
-                    qtw.QMessageBox.warning(None,
-                                            'Too many retries',
-                                            'Too many retries, program will quit')
-                    sys.exit()
-                msgbox = qtw.QMessageBox()
-                msgbox.setWindowTitle('No Spectrometers Available')
-                msgbox.setText('Please connect a spectrometer.\n'
-                               'If spectrometer is already connected, please make sure it is not already in use.\n'
-                               'Troubleshoot: try reconnecting USB cable to spectrometer.')
-                msgbox.addButton(qtw.QMessageBox.Retry)
-                msgbox.addButton(qtw.QMessageBox.Abort)
-                msgbox.addButton(qtw.QMessageBox.Ignore)
-                choice = msgbox.exec_()
-                if choice == qtw.QMessageBox.Retry:
-                    retries += 1
-                elif choice == qtw.QMessageBox.Ignore:
-                    qtw.QMessageBox.information(None,
-                                                'No spectrometer',
-                                                'No spectrometer found, entering data viewing mode (future).\n'
-                                                'Exiting program (temporary until data-only implemented).')
-                    sys.exit()
-                elif choice == qtw.QMessageBox.Abort:
-                    sys.exit()
-            elif num_devices == 2:
-                msgbox = qtw.QMessageBox()
-                msgbox.setWindowTitle('Multiple Spectrometers')
-                msgbox.setText('Two spectrometers found.\n'
-                               'Please select between the spectrometers below:')
-                msgbox.addButton(str(devices[0]), qtw.QMessageBox.YesRole)
-                msgbox.addButton(str(devices[1]), qtw.QMessageBox.NoRole)
-                choice = msgbox.exec_()
-                index = choice
-            else:
-                # refuse 3+ spectrometers
-                msgbox = qtw.QMessageBox.warning(None,
-                                                 'Too many spectrometers',
-                                                 'Please limit number of spectrometers and run program again.')
-                sys.exit()
-        # initialize spectrometer and check serial number is valid
-        self.spec = sb.Spectrometer(devices[index])
-        if self.spec.serial_number not in spec_list:
-            msg = qtw.QMessageBox.warning(None,
-                                          'Spectrometer not recognized',
-                                          'The serial number of your spectrometer is not recognized.\n'
-                                          'Contact HPCAT staff to add your spectrometer to the list of approved devices.')
-            sys.exit()
-        # set default integration time of 100 ms
-        self.spec.integration_time_micros(100000)
-
-        # establish initial spectrum
-        self.xs = self.spec.wavelengths()
-        self.ys = self.spec.intensities()
+    def __init__(self, spec=None, ring_capacity=2048, startup=None):
+        # StartupTimer told when the first spectrum arrives, if any
+        self.startup = startup
+        # the spectrometer is attached later by attach(), until then RubyRead is a data viewer
+        self.spec = None
+        # held while reading spectra, opening or closing the device, so that the DeviceWatcher
+        # never lists devices in the middle of one of them
+        self.device_lock = threading.Lock()
+        # averaging of n spectra, on the device when it supports it
+        self.acquisition = None
+
+        # default integration time of 100 ms, sent to the spectrometer when it is attached
+        self.integration_time = 100
+        self.average = False
+        self.num_average = 1
+
+        # establish initial spectrum, on a placeholder axis until a spectrometer or file provides one
+        self.sequence = itertools.count()
+        self.xs = np.linspace(670.0, 720.0, 2048)
+        # history of the last ring_capacity collected spectra
+        self.ring = SpectrumRing(ring_capacity, self.xs)
+        # SpectrumLog while File > Record spectra is checked
+        self.log = None
+        # averaged dark spectra by integration time, subtracted from new frames when enabled
+        self.darks = DarkStore()
+        self.subtract_dark = False
+        # pressure, R1 and fit status of every fit over time, for the history plot
+        self.history = PressureHistory()
+        self.set_frame(self.new_frame(np.zeros(len(self.xs)), integration_time=None, store=False))
 
         # define initial fit boundaries
         self.roi_min = 150
         self.roi_max = 150
 
+        # reuse the previous fit as the initial guess while R1 stays within tolerance (nm)
+        self.warm_start = True
+        self.warm_start_tolerance = 0.5
+
+        # optionally show a fast R1 estimate on every frame and run the full fit every fit_interval (s)
+        self.quick_estimate = False
+        self.fit_interval = 1.0
+        self.last_fit_request = 0.0
+
+        # collected spectra are redrawn at most this many times a second
+        self.max_fps = 30
+
         # TODO: send below parameters to fitting as needed
-        # define plot and fit limits from hardware specifications
-        self.max_intensity = self.spec.max_intensity
-        self.num_pixels = self.spec.pixels
+        # define plot and fit limits from hardware specifications, replaced by attach()
+        self.max_intensity = 65535
+        self.num_pixels = len(self.xs)
 
         # set initial roi arrays
         default_zoom = np.abs(self.xs-694.260).argmin()
@@ -1337,8 +1634,6 @@ class CoreData:
         self.ys_roi = self.ys[default_zoom - self.roi_min:default_zoom + self.roi_max]
 
         # variables to pass through thread
-        self.average = False
-        self.num_average = 1
         self.threshold = 1000
         self.warning = ''
 
@@ -1356,6 +1651,297 @@ class CoreData:
         self.temperature = 295
         self.pressure = 0.00
 
+        # a SpectrometerBackend given up front runs RubyRead without hardware
+        if spec is not None:
+            self.attach(spec)
+
+    def attach(self, spec):
+        # start collecting from spec, GUI thread only
+        with self.device_lock:
+            self.spec = spec
+            spec.integration_time_micros(int(self.integration_time * 1000))
+            self.acquisition = Acquisition(spec)
+            self.acquisition.set_scans(self.num_average if self.average else 1)
+            self.xs = spec.wavelengths()
+            # the ring holds spectra of one axis only, frames still on screen keep the old one alive
+            self.ring = SpectrumRing(self.ring.capacity, self.xs)
+            self.max_intensity = spec.max_intensity
+            self.num_pixels = spec.pixels
+            intensities = self.acquisition.spectrum()
+        self.set_frame(self.new_frame(intensities))
+        if self.startup is not None:
+            self.startup.mark('first spectrum')
+
+    def detach(self):
+        # back to data viewing, the last spectrum stays on screen
+        spec, self.spec = self.spec, None
+        self.acquisition = None
+        if spec is not None:
+            try:
+                with self.device_lock:
+                    spec.close()
+            except SPECTROMETER_ERRORS:
+                # already unplugged, the handle is released anyway
+                pass
+
+    def set_integration_time(self, integration_time):
+        # in ms, kept for the next spectrometer if none is attached
+        self.integration_time = integration_time
+        if self.spec is not None:
+            self.spec.integration_time_micros(int(integration_time * 1000))
+
+    def new_frame(self, intensities, integration_time='current', store=True):
+        # wrap freshly collected intensities, safe to call from the collection thread
+        if integration_time == 'current':
+            integration_time = self.integration_time
+        timestamp = time.time()
+        sequence = next(self.sequence)
+        if not store:
+            return Frame(self.xs, intensities, timestamp, integration_time, sequence)
+        # corrected on the way into the ring, no dark is kept for other integration times
+        dark = self.darks.dark(integration_time) if self.subtract_dark else None
+        ring = self.ring
+        slot = ring.append(intensities, timestamp, integration_time, sequence, dark)
+        # a view of the ring row, no copy, valid until the slot is reused (see Frame.stale)
+        frame = Frame(ring.xs, ring.intensities[slot], timestamp, integration_time, sequence, dark, ring, slot)
+        # read once, the GUI thread may stop recording at any time
+        log = self.log
+        if log is not None:
+            log.add_spectrum(frame)
+        return frame
+
+    def set_frame(self, frame):
+        # make frame the current spectrum, GUI thread only
+        self.frame = frame
+        self.xs = frame.xs
+        self.ys = frame.ys
+
+
+class Frame:
+    '''
+    One spectrum with its acquisition metadata, shared by reference between threads.
+
+    The wavelength and intensity arrays are made read-only on construction, so a frame can be
+    handed from collection to fitting to display without further copies.  Frames from
+    CoreData.new_frame hold a view of their row of the SpectrumRing, which is overwritten
+    `capacity` spectra later; stale() tells when that has happened, so a reader that may have
+    held the frame that long checks it after reading ys.  Copy the arrays before modifying them.
+    '''
+
+    __slots__ = ('xs', 'ys', 'timestamp', 'integration_time', 'sequence', 'dark', 'ring', 'slot')
+
+    def __init__(self, xs, ys, timestamp, integration_time, sequence, dark=None, ring=None, slot=None):
+        self.xs = np.asarray(xs)
+        self.ys = np.asarray(ys)
+        self.xs.flags.writeable = False
+        self.ys.flags.writeable = False
+        # timestamp is time.time() at collection, integration time in ms (None if unknown)
+        self.timestamp = timestamp
+        self.integration_time = integration_time
+        self.sequence = sequence
+        # the dark subtracted from ys, if any
+        self.dark = dark
+        # the SpectrumRing and slot ys is a view of, None if ys is not stored in a ring
+        self.ring = ring
+        self.slot = slot
+
+    def stale(self):
+        # True once the ring slot has been reused, or is being rewritten, and ys no longer holds this spectrum
+        return self.ring is not None and self.ring.sequences[self.slot] != self.sequence
+
+    def saturation_level(self, max_intensity):
+        # counts at which ys saturates, per pixel once a dark has been subtracted
+        if self.dark is None:
+            return max_intensity
+        return max_intensity - self.dark
+
+
+class SpectrumRing:
+    '''
+    Preallocated circular history of the most recent `capacity` spectra on the wavelength axis xs.
+
+    Every spectrum is copied once into its row of `intensities`, with its timestamp, integration
+    time (ms) and sequence number in the matching rows of the metadata arrays.  Readers get
+    views, never copies, so a view of a row is only valid until that slot is reused
+    `capacity` spectra later.  The slot's sequence number is -1 while the row is being written,
+    so a reader that finds the sequence it expects after reading the row read it whole.
+    Writers are serialized by a lock; readers do not block.
+    '''
+
+    def __init__(self, capacity, xs):
+        self.capacity = capacity
+        self.xs = xs
+        self.intensities = np.zeros((capacity, len(xs)))
+        self.timestamps = np.full(capacity, np.nan)
+        self.integration_times = np.full(capacity, np.nan)
+        self.sequences = np.full(capacity, -1, dtype=np.int64)
+        # total number of spectra ever written, the newest is in slot (count - 1) % capacity
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, intensities, timestamp, integration_time, sequence, dark=None):
+        # copy intensities, less dark if given, into the next slot and return the slot
+        with self.lock:
+            slot = self.count % self.capacity
+            self.sequences[slot] = -1
+            if dark is None:
+                self.intensities[slot] = intensities
+            else:
+                np.subtract(intensities, dark, out=self.intensities[slot])
+            self.timestamps[slot] = timestamp
+            self.integration_times[slot] = np.nan if integration_time is None else integration_time
+            self.sequences[slot] = sequence
+            self.count += 1
+        return slot
+
+    def frames(self):
+        # a Frame for each spectrum held, oldest first, viewing its row like those from new_frame
+        count = self.count
+        for index in range(count - len(self), count):
+            slot = index % self.capacity
+            integration_time = self.integration_times[slot]
+            if np.isnan(integration_time):
+                integration_time = None
+            yield Frame(self.xs, self.intensities[slot], self.timestamps[slot], integration_time,
+                        int(self.sequences[slot]), ring=self, slot=slot)
+
+
+class SpectrumCurve(pg.PlotDataItem):
+    '''
+    Raw spectrum curve that holds only the visible part of the spectrum, decimated to the view width.
+
+    The curve is not redrawn while the window is hidden or minimized, or when neither the
+    spectrum nor the view has changed.  dataBounds() reports the whole spectrum, so auto-ranging
+    and Zoom full still take in all of it.
+    '''
+
+    def __init__(self, *args, **kwds):
+        pg.PlotDataItem.__init__(self, *args, **kwds)
+        self.decimator = ViewportDecimator()
+        self.ys = None
+        self.drawn = None
+
+    def set_spectrum(self, xs, ys):
+        self.decimator.set_axis(xs)
+        self.ys = ys
+        return self.redraw()
+
+    def redraw(self):
+        # returns True if the curve was redrawn
+        view = self.getViewBox()
+        if self.ys is None or view is None or not on_screen(self):
+            return False
+        (x_min, x_max), columns = view.viewRange()[0], max(int(view.width()), 1)
+        arrays, view_state = (self.decimator.xs, self.ys), (x_min, x_max, columns)
+        if self.drawn is not None and self.drawn[0][0] is arrays[0] and self.drawn[0][1] is arrays[1] \
+                and self.drawn[1] == view_state:
+            return False
+        xs, ys = self.decimator.decimate(self.ys, x_min, x_max, columns)
+        self.setData(xs, ys)
+        self.drawn = (arrays, view_state)
+        return True
+
+    def draw_full(self):
+        # every pixel, e.g. for export, until the next redraw
+        if self.ys is not None:
+            self.setData(self.decimator.xs, self.ys)
+            self.drawn = None
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        if self.ys is None or not len(self.ys):
+            return pg.PlotDataItem.dataBounds(self, ax, frac, orthoRange)
+        if ax == 0:
+            return self.decimator.sorted_xs[0], self.decimator.sorted_xs[-1]
+        if orthoRange is not None:
+            extrema = self.decimator.extrema(self.ys, orthoRange[0], orthoRange[1])
+            return (None, None) if extrema is None else extrema
+        return np.nanmin(self.ys), np.nanmax(self.ys)
+
+
+class FitOverlay:
+    '''
+    Fit curves drawn over the spectrum: the full fit, R1 and R2 on the background, and the background.
+
+    Every curve is evaluated in one pass into arrays kept from fit to fit, and the plot items
+    stay in the plot, shown and hidden with setVisible.  A hidden curve is not updated until it
+    is shown again, from the arrays of the latest fit.
+    '''
+
+    def __init__(self, plot, fit_item, r1_item, r2_item, bg_item):
+        # the overlay is drawn on the GUI thread, the fit thread has its own kernel
+        self.kernel = PseudoVoigtKernel()
+        self.xs = None
+        self.curves = np.empty((4, 0))
+        # rows of PseudoVoigtKernel.double_pseudo_components, R2 is the first peak of popt
+        self.rows = {fit_item: 0, r2_item: 1, r1_item: 2, bg_item: 3}
+        self.stale = set()
+        for item in self.rows:
+            item.setVisible(False)
+            plot.addItem(item)
+
+    def set_fit(self, xs, popt):
+        if self.curves.shape[1] != len(xs):
+            self.curves = np.empty((4, len(xs)))
+        self.kernel.double_pseudo_components(xs, *popt, out=self.curves)
+        self.xs = xs
+        for item, row in self.rows.items():
+            if item.isVisible():
+                item.setData(xs, self.curves[row])
+            else:
+                self.stale.add(item)
+
+    def show(self, items, visible):
+        for item in items:
+            if visible and item in self.stale:
+                item.setData(self.xs, self.curves[self.rows[item]])
+                self.stale.discard(item)
+            item.setVisible(visible)
+
+
+class HistoryCurve(pg.PlotDataItem):
+    '''
+    Pressure history curve that holds only the time span in view, reduced to the view width.
+
+    While the time axis auto-ranges the whole history is drawn.  dataBounds() reports the whole
+    history, so View All still takes in all of it after zooming.
+    '''
+
+    def __init__(self, history, *args, **kwds):
+        pg.PlotDataItem.__init__(self, *args, **kwds)
+        self.history = history
+        self.drawn = None
+
+    def redraw(self):
+        # returns True if the curve was redrawn
+        view = self.getViewBox()
+        span = self.history.span()
+        if span is None or view is None or not on_screen(self):
+            return False
+        if view.autoRangeEnabled()[0]:
+            t_min, t_max = span
+        else:
+            t_min, t_max = view.viewRange()[0]
+        drawn = (len(self.history), t_min, t_max, max(int(view.width()), 1))
+        if drawn == self.drawn:
+            return False
+        times, pressures = self.history.series(t_min, t_max, drawn[3])
+        self.setData(times, pressures)
+        self.drawn = drawn
+        return True
+
+    def clear(self):
+        pg.PlotDataItem.clear(self)
+        self.drawn = None
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        span = self.history.span()
+        if ax == 0 and span is not None:
+            return span
+        return pg.PlotDataItem.dataBounds(self, ax, frac, orthoRange)
+
 
 class CustomViewBox(pg.ViewBox):
     def __init__(self, *args, **kwds):
@@ -1422,6 +2008,9 @@ class CalibrationEntry(qtw.QWidget):
         self.wave_error = qtw.QLineEdit()
         self.wave_error.setFixedWidth(60)
 
+        # reusable model buffers for the peak fits below
+        self.kernel = PseudoVoigtKernel()
+
         # connect signals
         self.pixel_input.textChanged.connect(lambda text: self.fit_and_fill(text))
 
@@ -1462,11 +2051,12 @@ class CalibrationEntry(qtw.QWidget):
         w0 = [height, position, 0.5, 1.0, slope, intercept]
         print(height, position, slope, intercept)
         # fit peaks against pixels
-        popt, _ = curve_fit(pseudo, local_pixels, local_ys, p0)
+        from scipy.optimize import curve_fit
+        popt, _ = curve_fit(self.kernel.pseudo, local_pixels, local_ys, p0, jac=self.kernel.pseudo_jac)
         print(popt)
         self.pixel_fit.setText('%.3f' % popt[1])
         # fit curve against wavelength
-        wopt, _ = curve_fit(pseudo, local_xs, local_ys, w0)
+        wopt, _ = curve_fit(self.kernel.pseudo, local_xs, local_ys, w0, jac=self.kernel.pseudo_jac)
         print(wopt)
         self.wave_fit.setText('%.3f' % wopt[1])
         wave_cal = calibration_lines[np.abs(calibration_lines - wopt[1]).argmin()]
@@ -1483,37 +2073,63 @@ class CalibrationEntry(qtw.QWidget):
 
 
 class CollectSpecs(qtc.QObject):
+    '''
+    Collect spectra until stopped or core.duration runs out, handing the GUI only the newest.
 
-    spectra_returned_signal = qtc.pyqtSignal(dict)
+    Each spectrum replaces the one waiting in `newest`, and spectra_returned_signal is only
+    emitted when the GUI thread has taken the previous one with take(), so a GUI thread that
+    falls behind gets one queued event rather than one per spectrum.
+    '''
+
+    spectra_returned_signal = qtc.pyqtSignal()
+    collection_done_signal = qtc.pyqtSignal()
+    spectrometer_lost_signal = qtc.pyqtSignal(str)
 
     def __init__(self):
         super().__init__()
         self.go = False
+        # the newest data_dict not yet taken by the GUI and the number of spectra since the last take
+        self.lock = threading.Lock()
+        self.newest = None
+        self.arrived = 0
 
     def collect_specs(self, emit_sig):
         self.go = emit_sig
-        data_dict = {'remaining_time': '', 'raw_y': ''}
         start_time = time.perf_counter()
         while self.go:
-            # get the spectrum
-            intensities = core.spec.intensities()
-            # average if needed
-            if core.average:
-                num = core.num_average
-                for each in range(num - 1):
-                    intensities += core.spec.intensities()
-                intensities = intensities / num
+            # get the spectrum, averaged by the device or into the acquisition buffer
+            acquisition = core.acquisition
+            if acquisition is None:
+                break
+            try:
+                with core.device_lock:
+                    intensities = acquisition.spectrum()
+            except SPECTROMETER_ERRORS:
+                # unplugged mid-collection, the GUI detaches it and looks for spectrometers again
+                self.spectrometer_lost_signal.emit(acquisition.spec.serial_number)
+                break
             # determine remaining time to collect spectra
             remaining_time = core.duration - (time.perf_counter() - start_time)
-            # update dictionary values and send the dict signal
-            data_dict['remaining_time'] = remaining_time
-            data_dict['raw_y'] = intensities
-            self.spectra_returned_signal.emit(data_dict)
+            data_dict = {'remaining_time': remaining_time, 'frame': core.new_frame(intensities)}
+            with self.lock:
+                waiting = self.newest is not None
+                self.newest = data_dict
+                self.arrived += 1
+            # a signal is already queued if the GUI has not taken the last one, it takes this one instead
+            if not waiting:
+                self.spectra_returned_signal.emit()
             # check if it's time to stop
             if not remaining_time > 0:
                 self.stop()
-        data_dict['remaining_time'] = 0
-        self.spectra_returned_signal.emit(data_dict)
+        self.collection_done_signal.emit()
+
+    def take(self):
+        # (newest data_dict or None, spectra collected since the last take), GUI thread only
+        with self.lock:
+            data_dict, arrived = self.newest, self.arrived
+            self.newest = None
+            self.arrived = 0
+        return data_dict, arrived
 
     def stop(self):
         self.go = False
@@ -1525,66 +2141,261 @@ class FitSpecs(qtc.QObject):
 
     def __init__(self):
         super().__init__()
+        # model buffers are owned by the fit thread
+        self.kernel = PseudoVoigtKernel()
+        # last converged parameters, used to warm start the next fit
+        self.last_popt = None
+
+    def fit_specs(self, frame):
+        # only the frame is read here, the GUI takes the ROI views from fit_dict
+        fit_dict = {'warning': '', 'popt': '', 'frame': frame}
+        # start by defining ROI arrays around the spectrum maximum
+        roi_start, roi_stop = roi_bounds(frame.ys, core.roi_min, core.roi_max)
+        fit_dict['xs_roi'] = frame.xs[roi_start:roi_stop]
+        fit_dict['ys_roi'] = frame.ys[roi_start:roi_stop]
+        # try the previous result first if R1 has barely moved, fall back to the heuristic guess
+        tolerance = core.warm_start_tolerance if core.warm_start else 0.0
+        status, popt, r1_error = fit_spectrum(frame.xs, frame.ys, roi_start, roi_stop, core.threshold,
+                                              frame.saturation_level(core.max_intensity), self.kernel,
+                                              previous_popt=self.last_popt, tolerance=tolerance, full_output=True)
+        if frame.stale():
+            # the ring slot was reused during the fit, ys may have held parts of two spectra
+            fit_dict['status'] = LOG_NOT_FITTED
+            fit_dict['r1_error'] = np.nan
+            fit_dict['warning'] = 'Spectrum overwritten during fit'
+            self.fit_returned_signal.emit(fit_dict)
+            return
+        self.last_popt = popt
+        fit_dict['status'] = status
+        fit_dict['r1_error'] = r1_error
+        if status == FIT_OK:
+            fit_dict['popt'] = popt
+        fit_dict['warning'] = FIT_WARNINGS[status]
+        self.fit_returned_signal.emit(fit_dict)
+
+
+class FitScheduler(qtc.QObject):
+    '''
+    Hand fit requests to FitSpecs one at a time, always fitting the newest spectrum.
+
+    Frames that arrive while a fit is running replace any frame already waiting, and the
+    waiting frame is dispatched when the running fit returns.  Each frame replaced that way is
+    counted in `skipped`.
+    '''
+
+    fit_dispatched_signal = qtc.pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.busy = False
+        self.pending = None
+        self.skipped = 0
+
+    def request(self, frame):
+        if self.busy:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = frame
+            return
+        self.busy = True
+        self.fit_dispatched_signal.emit(frame)
+
+    def fit_done(self):
+        self.busy = False
+        if self.pending is not None:
+            frame = self.pending
+            self.pending = None
+            self.request(frame)
+
+
+class DisplayLimiter(qtc.QObject):
+    '''
+    Redraw collected spectra at most core.max_fps times a second, always showing the newest one.
+    The pressure history has its own limiter, fed with fit results instead of spectra.
 
-    def fit_specs(self):
-        fit_dict = {'warning': '', 'popt': ''}
-        # start by defining ROI arrays and get max_index for ROI
-        full_max_index = np.argmax(core.ys)
-        roi_min = full_max_index - core.roi_min
-        roi_max = full_max_index + core.roi_max
-        # handle edge situations (for example, during background-only spectra)
-        if roi_min < 0:
-            roi_min = 0
-        if roi_max > core.num_pixels - 1:
-            roi_max = -1
-        core.xs_roi = core.xs[roi_min:roi_max]
-        core.ys_roi = core.ys[roi_min:roi_max]
-        roi_max_index = np.argmax(core.ys_roi)
-        # start with approximate linear background (using full spectrum)
-        slope = (core.ys[-1] - core.ys[0]) / (core.xs[-1] - core.xs[0])
-        intercept = core.ys[0] - slope * core.xs[0]
-        # obtain initial guesses for fitting parameters using ROI array
-        r1_pos = core.xs_roi[roi_max_index]
-        r2_pos = r1_pos - 1.4
-        r1_height = core.ys_roi[roi_max_index] - (slope * r1_pos + intercept)
-        r2_height = r1_height / 2.0
-        local_xs = core.xs_roi
-        local_ys = core.ys_roi
-        # check r1_height is within range before fitting
-        if r1_height < core.threshold:
-            warning = 'Too weak'
-        elif core.ys_roi[roi_max_index] > core.max_intensity - 1:
-            warning = 'Saturated'
+    Every spectrum collected is counted in `acquired`.  If the display was redrawn less than a
+    frame period ago, a single redraw is scheduled for the end of the period instead, and spectra
+    arriving meanwhile are coalesced into it.  Redraws are counted in `drawn`.
+    '''
+
+    draw_signal = qtc.pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.acquired = 0
+        self.drawn = 0
+        self.last_draw = 0.0
+        self.timer = qtc.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.draw)
+
+    def frame_arrived(self, count=1):
+        # count spectra were collected since the last call, the newest is core.frame
+        self.acquired += count
+        if self.timer.isActive():
+            return
+        wait = self.last_draw + 1 / core.max_fps - time.perf_counter()
+        if wait > 0:
+            self.timer.start(int(wait * 1000) + 1)
         else:
-            # define fitting parameters p0 (area approximated by height)
-            p0 = [r2_height, r2_pos, 0.5, 1.0, r1_height, r1_pos, 0.5, 1.0, slope, intercept]
+            self.draw()
+
+    def draw(self):
+        self.last_draw = time.perf_counter()
+        self.drawn += 1
+        self.draw_signal.emit()
+
+    def reset(self):
+        self.acquired = 0
+        self.drawn = 0
+
+
+class DeviceWatcher(qtc.QObject):
+    '''
+    Look for approved spectrometers off the GUI thread, then watch the one opened until it is unplugged.
+
+    USB enumeration can take seconds on a cold start, so the main window comes up first and the
+    spectrometer is attached whenever device_connected_signal delivers it.  The watcher then
+    lists the devices every `interval` seconds and sends device_disconnected_signal once the
+    attached one is gone, whether or not spectra are being collected; seabreeze is not
+    documented as thread-safe, so it only lists them under core.device_lock.  The GUI starts
+    watching again after a disconnect.  If several approved spectrometers are connected,
+    devices_found_signal offers their serial numbers and the one set as `choice` is opened.
+    Unrecognized spectrometers are reported once each through device_rejected_signal.
+    '''
+
+    device_connected_signal = qtc.pyqtSignal(object)
+    device_disconnected_signal = qtc.pyqtSignal(str)
+    devices_found_signal = qtc.pyqtSignal(list)
+    device_rejected_signal = qtc.pyqtSignal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.go = False
+        self.rejected = set()
+        self.interval = 1.0
+        # serial number picked by the operator, set from the GUI thread
+        self.choice = None
+        self.offered = None
+
+    def watch(self, go):
+        # the seabreeze import is part of the slow start, so it happens here rather than at launch
+        load_seabreeze()
+        self.go = go
+        self.choice = None
+        self.offered = None
+        spec = self.wait(self.poll)
+        if spec is None:
+            return
+        self.device_connected_signal.emit(spec)
+        serial_number = self.wait(self.missing, spec.serial_number)
+        if serial_number is not None:
+            self.device_disconnected_signal.emit(serial_number)
+
+    def wait(self, check, *args):
+        # call check every interval until it returns something, or None once watching stops
+        while self.go:
             try:
-                popt, pcov = curve_fit(double_pseudo, local_xs, local_ys, p0=p0)
-                warning = ''
-                fit_dict['popt'] = popt
-            except RuntimeError:
-                warning = 'Poor fit'
-        fit_dict['warning'] = warning
-        self.fit_returned_signal.emit(fit_dict)
+                with core.device_lock:
+                    result = check(*args)
+            except SPECTROMETER_ERRORS:
+                # busy, half-enumerated or in use by another program, try again next time round
+                result = None
+            if result is not None:
+                return result
+            time.sleep(self.interval)
+        return None
+
+    def missing(self, serial_number):
+        # serial_number once that spectrometer is no longer connected, otherwise None
+        if any(device.serial_number == serial_number for device in sb.list_devices()):
+            return None
+        return serial_number
+
+    def poll(self):
+        # one look at the connected devices, returns the opened spectrometer to attach or None
+        devices = {device.serial_number: device for device in sb.list_devices()}
+        for serial_number in devices:
+            if serial_number not in APPROVED_SPECTROMETERS and serial_number not in self.rejected:
+                self.rejected.add(serial_number)
+                self.device_rejected_signal.emit(serial_number)
+        approved = sorted(serial_number for serial_number in devices if serial_number in APPROVED_SPECTROMETERS)
+        if len(approved) > 1:
+            if self.choice not in approved:
+                # ask once for each set of spectrometers
+                if approved != self.offered:
+                    self.offered = approved
+                    self.devices_found_signal.emit(approved)
+                return None
+            approved = [self.choice]
+        if not approved:
+            return None
+        return sb.Spectrometer(devices[approved[0]])
+
+    def stop(self):
+        self.go = False
+
+
+class StartupTimer:
+    '''
+    Seconds from launch to each startup milestone, printed as each is reached.
+
+    Milestones are 'imports', 'core ready', 'window visible', 'fitting loaded' and
+    'first spectrum', the last only once a spectrometer delivers one.
+    '''
+
+    def __init__(self, start):
+        self.start = start
+        self.marks = {}
+
+    def mark(self, name):
+        # only the first time each milestone is reached counts
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - self.start
+            print('startup: %-16s %6.3f s' % (name, self.marks[name]))
 
 
 def update():
-    # take current intesities and plot them
+    # take current intesities and plot the part in view
+    gui.raw_data.set_spectrum(core.xs, core.ys)
     # Set up y scaling options
     if gui.scale_y_btn_grp.checkedId() == 1:
         viewable = vb.viewRange()
-        left_index = np.abs(core.xs-viewable[0][0]).argmin()
-        right_index = np.abs(core.xs-viewable[0][1]).argmin()
-        view_min = core.ys[left_index:right_index].min()
-        view_max = core.ys[left_index:right_index].max()
-        if view_max > viewable[1][1]:
-            vb.setRange(yRange=(view_min, view_max))
-        if view_min < viewable[1][0]:
-            vb.setRange(yRange=(view_min, viewable[1][1]))
-    # y scaling done, ready to assign new data to curve
-    gui.raw_data.setData(core.xs, core.ys)
+        extrema = gui.raw_data.decimator.extrema(core.ys, viewable[0][0], viewable[0][1])
+        if extrema is not None:
+            view_min, view_max = extrema
+            if view_max > viewable[1][1]:
+                vb.setRange(yRange=(view_min, view_max))
+            if view_min < viewable[1][0]:
+                vb.setRange(yRange=(view_min, viewable[1][1]))
     if gui.fit_n_spec_btn.isChecked():
-        gui.fit_requested_signal.emit(True)
+        if core.quick_estimate:
+            quick_estimate()
+            now = time.perf_counter()
+            if now - core.last_fit_request < core.fit_interval:
+                return
+            core.last_fit_request = now
+        # while collecting this runs once per redraw, so continuous fits are requested at most core.max_fps a second
+        gui.fit_requested_signal.emit(core.frame)
+
+
+def on_screen(item):
+    # False while the window showing a plot item is hidden or minimized
+    widget = item.getViewWidget()
+    if widget is None:
+        return False
+    window = widget.window()
+    return window.isVisible() and not window.isMinimized()
+
+
+def quick_estimate():
+    # cheap R1 position for live feedback, the full fit overwrites it when it returns
+    status, lambda_r1 = estimate_r1(core.xs, core.ys, core.threshold, core.frame.saturation_level(core.max_intensity))
+    if status == FIT_OK:
+        core.lambda_r1 = lambda_r1
+        gui.lambda_r1_display.setText('%.3f' % lambda_r1)
+        gui.vline_press.setPos(lambda_r1)
+        calculate_pressure(lambda_r1)
 
 
 def calculate_pressure(lambda_r1):
@@ -1593,30 +2404,19 @@ def calculate_pressure(lambda_r1):
     gui.calculate_deltas()
 
 
-def double_pseudo(x, a1, c1, eta1, w1, a2, c2, eta2, w2, m, bg):
-    return a1 * (eta1 * (2 / pi) * (w1 / (4 * (x - c1) ** 2 + w1 ** 2)) +
-                 (1 - eta1) * (sqrt(4 * np.log(2)) / (sqrt(pi) * w1)) * np.exp(
-                -(4 * np.log(2) / w1 ** 2) * (x - c1) ** 2)) + \
-           a2 * (eta2 * (2 / pi) * (w2 / (4 * (x - c2) ** 2 + w2 ** 2)) +
-                 (1 - eta2) * (sqrt(4 * np.log(2)) / (sqrt(pi) * w2)) * np.exp(
-                -(4 * np.log(2) / w2 ** 2) * (x - c2) ** 2)) + \
-           m * x + bg
-
-
-def pseudo(x, a, c, eta, w, m, bg):
-    return a * (eta * (2 / pi) * (w / (4 * (x - c) ** 2 + w ** 2)) +
-                (1 - eta) * (sqrt(4 * np.log(2)) / (sqrt(pi) * w)) * np.exp(
-                -(4 * np.log(2) / w ** 2) * (x - c) ** 2)) + m * x + bg
-
-
-def double_moffat(x, a1, c1, w1, b1, a2, c2, w2, b2, m, bg):
-    return a1*((((x - c1)/w1)**2 + 1)**-b1) + \
-           a2*((((x - c2)/w2)**2 + 1)**-b2) + \
-           m*x + bg
+def load_seabreeze():
+    # import seabreeze on first use, from whichever thread needs it first
+    global sb, SPECTROMETER_ERRORS
+    if sb is None:
+        import seabreeze.spectrometers as spectrometers
+        SPECTROMETER_ERRORS = (spectrometers.SeaBreezeError,)
+        sb = spectrometers
 
 
-def moffat(x, a, c, w, b, m, bg):
-    return a*((((x - c)/w)**2 + 1)**-b) + m*x + bg
+def preload_fitting(startup):
+    # import scipy.optimize off the GUI thread so that the first fit does not wait for it
+    importlib.import_module('scipy.optimize')
+    startup.mark('fitting loaded')
 
 
 def recall_lambda_naught():
@@ -1632,11 +2432,42 @@ def recall_lambda_naught():
         print('File format not correct, unable to update zero pressure wavelength')
 
 
+def parse_args(argv):
+    # --simulate or --replay run without a spectrometer, e.g. to benchmark collect -> fit -> display
+    parser = argparse.ArgumentParser(description='Measure ruby pressure')
+    parser.add_argument('--simulate', metavar='GPA', type=float, nargs='?', const=0.0,
+                        help='use a simulated spectrometer at this pressure')
+    parser.add_argument('--replay', metavar='FILE', help='replay the spectra of an SPE or CSV file')
+    parser.add_argument('--noise', type=float, default=20.0, help='simulated noise (counts)')
+    parser.add_argument('--frame-rate', type=float, help='simulated or replayed frames per second')
+    parser.add_argument('--ring-size', type=int, default=2048,
+                        help='number of recent spectra kept in memory (default 2048)')
+    args, unknown = parser.parse_known_args(argv[1:])
+    if args.ring_size < 1:
+        parser.error('--ring-size must be at least 1')
+    return args
+
+
+def spectrometer_from_args(args):
+    if args.replay:
+        return ReplaySpectrometer(args.replay, frame_rate=args.frame_rate)
+    if args.simulate is not None:
+        return SimulatedSpectrometer(args.simulate, noise=args.noise, frame_rate=args.frame_rate)
+    return None
+
+
 if __name__ == '__main__':
+    startup = StartupTimer(LAUNCH_TIME)
+    startup.mark('imports')
     app = qtw.QApplication(sys.argv)
-    core = CoreData()
+    args = parse_args(sys.argv)
+    core = CoreData(spectrometer_from_args(args), ring_capacity=args.ring_size, startup=startup)
+    startup.mark('core ready')
     vb = CustomViewBox()
     gui = MainWindow()
+    # runs once the event loop has shown the window
+    qtc.QTimer.singleShot(0, lambda: startup.mark('window visible'))
+    threading.Thread(target=preload_fitting, args=(startup,), name='preload fitting', daemon=True).start()
     update()
     recall_lambda_naught()
     sys.exit(app.exec_())
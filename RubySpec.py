@@ -0,0 +1,204 @@
+__author__ = 'jssmith'
+
+'''
+Spectrum acquisition for RubyRead
+
+Acquisition wraps a spectrometer and returns averaged spectra, using the device's own scan
+averaging where the spectrometer has it and a single preallocated buffer where it does not.
+
+Anything with the SpectrometerBackend interface can stand in for a seabreeze Spectrometer:
+SimulatedSpectrometer synthesizes ruby spectra and ReplaySpectrometer plays back SPE or CSV
+files, so collection, fitting and display run on machines without a spectrometer.
+'''
+
+import abc
+import numpy as np
+import time
+from SPrEader import SpeFile
+
+
+def device_averaging(spec):
+    # seabreeze lists on-device scan averaging as the spectrum_processing feature, when the device has it
+    features = getattr(spec, 'features', None)
+    if not isinstance(features, dict):
+        return None
+    processing = features.get('spectrum_processing')
+    if processing and hasattr(processing[0], 'set_scans_to_average'):
+        return processing[0]
+    return None
+
+
+class Acquisition:
+    '''
+    Averaged spectra from one spectrometer.
+
+    spectrum() returns the average of `scans` spectra.  With on-device averaging the device returns
+    the average itself; otherwise spectra are summed into one float64 buffer that is reused by
+    every call, so the result is only valid until the next call (CoreData.new_frame copies it
+    into the ring straight away).
+    '''
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.processing = device_averaging(spec)
+        self.buffer = np.zeros(len(spec.wavelengths()))
+        self.scans = 1
+
+    @property
+    def device_averaging(self):
+        return self.processing is not None
+
+    def set_scans(self, scans):
+        scans = max(int(scans), 1)
+        if self.processing is not None:
+            self.processing.set_scans_to_average(scans)
+        self.scans = scans
+
+    def spectrum(self):
+        if self.scans == 1 or self.processing is not None:
+            return self.spec.intensities()
+        buffer = self.buffer
+        buffer[:] = self.spec.intensities()
+        for each in range(self.scans - 1):
+            np.add(buffer, self.spec.intensities(), out=buffer)
+        buffer /= self.scans
+        return buffer
+
+
+class SpectrometerBackend(abc.ABC):
+    '''
+    The part of the seabreeze Spectrometer interface RubyRead uses.
+
+    wavelengths() and intensities() return float arrays of `pixels` values,
+    integration_time_micros(micros) sets the integration time and close() releases the device.
+    max_intensity is the saturation level in counts.  Subclasses must implement wavelengths()
+    and intensities(), and call _wait() in intensities() to pace frames like a device.
+    '''
+
+    serial_number = ''
+    pixels = 0
+    max_intensity = 65535.0
+    # no on-device averaging, see device_averaging()
+    features = {}
+
+    def __init__(self, frame_rate=None):
+        # frames are delivered every integration time, or at frame_rate (Hz) if given
+        self.frame_rate = frame_rate
+        self.integration_time = 0.1
+        self._due = time.perf_counter()
+
+    @abc.abstractmethod
+    def wavelengths(self):
+        pass
+
+    @abc.abstractmethod
+    def intensities(self):
+        pass
+
+    def integration_time_micros(self, micros):
+        self.integration_time = micros / 1e6
+
+    def close(self):
+        pass
+
+    def _wait(self):
+        # sleep until the next frame is due, without catching up on frames missed while busy
+        period = 1 / self.frame_rate if self.frame_rate else self.integration_time
+        now = time.perf_counter()
+        if self._due > now:
+            time.sleep(self._due - now)
+            now = self._due
+        self._due = now + period
+
+
+class SimulatedSpectrometer(SpectrometerBackend):
+    '''
+    Ruby R1/R2 spectra at a set pressure, with Gaussian noise on a flat background.
+
+    pressure is in GPa, or a function of the seconds since the device was made for pressure
+    ramps.  Peak height scales with integration time as on a real detector and is clipped at
+    max_intensity.
+    '''
+
+    serial_number = 'SIMULATED'
+
+    def __init__(self, pressure=0.0, noise=20.0, frame_rate=None, pixels=2048, wavelength_range=(670.0, 720.0),
+                 amplitude=8000.0, width=0.6, background=1000.0, max_intensity=16383.0,
+                 lambda_0=694.260, alpha=1870, beta=10.69, seed=None):
+        super().__init__(frame_rate)
+        self.pressure = pressure
+        self.noise = noise
+        self.pixels = pixels
+        self.amplitude = amplitude
+        self.width = width
+        self.background = background
+        self.max_intensity = max_intensity
+        self.lambda_0 = lambda_0
+        self.alpha = alpha
+        self.beta = beta
+        self._wavelengths = np.linspace(wavelength_range[0], wavelength_range[1], pixels)
+        self._rng = np.random.default_rng(seed)
+        self._start = time.perf_counter()
+
+    def wavelengths(self):
+        return self._wavelengths.copy()
+
+    def lambda_r1(self):
+        # invert the ruby pressure scale used by calculate_pressure
+        pressure = self.pressure(time.perf_counter() - self._start) if callable(self.pressure) else self.pressure
+        return self.lambda_0 * (1 + self.beta * pressure / self.alpha) ** (1 / self.beta)
+
+    def intensities(self):
+        self._wait()
+        xs = self._wavelengths
+        r1 = self.lambda_r1()
+        # counts for a 100 ms integration, R2 about 1.4 nm below R1 at roughly half the height
+        height = self.amplitude * self.integration_time / 0.1
+        half_width = (self.width / 2) ** 2
+        ys = height * (half_width / ((xs - r1) ** 2 + half_width) +
+                       0.55 * half_width / ((xs - r1 + 1.4) ** 2 + half_width))
+        ys += self.background + self._rng.normal(0.0, self.noise, self.pixels)
+        return np.clip(ys, 0, self.max_intensity)
+
+
+class ReplaySpectrometer(SpectrometerBackend):
+    '''
+    Play back the frames of an SPE file, or the spectra of a CSV file, as if collected live.
+
+    CSV files hold wavelengths in the first column and one spectrum per following column, after
+    a header line, as written by File > Save.  Playback loops unless loop=False, in which case
+    the last frame repeats.  The integration time set by RubyRead only paces playback.
+    '''
+
+    serial_number = 'REPLAY'
+
+    def __init__(self, name, frame_rate=None, loop=True, max_intensity=65535.0):
+        super().__init__(frame_rate)
+        if name.lower().endswith('.spe'):
+            spe = SpeFile(name)
+            self._wavelengths = np.array(spe.xaxis, dtype=float)
+            # mapped, frames are read from disk as they are played
+            self._frames = spe.mapped_data.reshape(spe.header.NumFrames, -1)
+        else:
+            table = np.genfromtxt(name, delimiter=',', skip_header=1, filling_values=1, ndmin=2)
+            self._wavelengths = table[:, 0]
+            self._frames = table[:, 1:].T
+        if not len(self._frames):
+            raise ValueError('%s has no spectra to replay' % name)
+        self.name = name
+        self.loop = loop
+        self.pixels = len(self._wavelengths)
+        self.max_intensity = max_intensity
+        self.index = 0
+
+    def wavelengths(self):
+        return self._wavelengths.copy()
+
+    def intensities(self):
+        self._wait()
+        ys = np.array(self._frames[self.index], dtype=float)
+        if self.index + 1 < len(self._frames):
+            self.index += 1
+        elif self.loop:
+            self.index = 0
+        return ys
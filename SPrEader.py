@@ -4,8 +4,14 @@ import ctypes, os
 import struct
 import numpy as np
 import logging
+import json
+import time
+import hashlib
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
-__all__ = ['SpeFile', 'print_offsets']
+__all__ = ['SpeFile', 'SpeIndex', 'read_header', 'read_headers', 'decode_headers', 'header_dtype',
+           'read_xaxis', 'calibrated_axis', 'print_offsets']
 
 __author__ = "Anton Loukianov"
 __email__ = "anton.loukianov@gmail.com"
@@ -71,7 +77,8 @@ def print_offsets():
 class SpeFile(object):
     ''' A file that represents the SPE file.
     All details written in the file are contained in the `header` structure. Data is
-    accessed by using the `data` property.
+    accessed by using the `data` property, or lazily by using `mapped_data` or `frame`.
+    Iterating over the object, or over iter_blocks, reads frames in constant memory.
     Once the object is created and data accessed, the file is NOT read again. Create
     a new object if you want to reread the file.
     '''
@@ -79,6 +86,13 @@ class SpeFile(object):
     # Map between header datatype field and numpy datatype
     _datatype_map = {0 : np.float32, 1 : np.int32, 2 : np.int16, 3 : np.uint16}
 
+    # Map between SPE 3.0 footer pixelFormat and numpy datatype
+    _pixel_format_map = {'MonochromeUnsigned16' : np.uint16, 'MonochromeUnsigned32' : np.uint32,
+                         'MonochromeFloating32' : np.float32}
+
+    # Map between SPE 3.0 footer metadata types and numpy datatypes
+    _meta_type_map = {'Int64' : '<i8', 'Double' : '<f8'}
+
     def __init__(self, name):
         ''' Open file `name` to read the header.'''
 
@@ -112,6 +126,105 @@ class SpeFile(object):
 
         self.readout_time = self.header.ReadoutTime
 
+        # LightField (SPE 3.0) files describe their layout in an XML footer, WinSpec files in
+        # the header alone.  Either way every frame is read through the same record dtype.
+        self.version = self.header.file_header_ver
+        self.regions = []
+        self.sensor_mapping = []
+        self.wavelengths = None
+        self.absolute_times = {}
+        self._meta = []
+
+        if self.version >= 3:
+            self._read_footer()
+        else:
+            self._pixel_dtype = np.dtype(SpeFile._datatype_map[self.header.datatype])
+            self.frame_size = self.header.xdim * self.header.ydim * self._pixel_dtype.itemsize
+            self.frame_stride = self.frame_size
+
+        self._frame_dtype = self._make_frame_dtype()
+
+    def _read_footer(self):
+        ''' Stream the XML footer of an SPE 3.0 file
+        The footer offset is stored at byte 678 of the header.  Only the DataFormat, MetaFormat
+        and Calibrations sections are parsed, the parser stops before the (often long) data
+        histories, and nothing but the footer is read from the file.  The header's xdim, ydim and
+        NumFrames are set from the first region of interest, which is the one `data` returns.
+        '''
+
+        footer_offset, = struct.unpack_from('<Q', bytes(self.header), 678)
+        frame_block = None
+        in_meta = False
+
+        with open(self.path, mode='rb') as f:
+            f.seek(footer_offset)
+
+            for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+                tag = element.tag.rpartition('}')[2]
+
+                if event == 'start':
+                    if tag == 'DataBlock' and element.get('type') == 'Frame':
+                        frame_block = dict(element.attrib)
+                    elif tag == 'DataBlock' and element.get('type') == 'Region':
+                        self.regions.append({key : int(element.get(key, 0))
+                                             for key in ('width', 'height', 'size', 'stride')})
+                    elif tag == 'MetaBlock':
+                        in_meta = True
+                    elif in_meta:
+                        # metadata written after each frame, in footer order
+                        name = element.get('event') or tag + element.get('component', '')
+                        meta_type = SpeFile._meta_type_map.get(element.get('type'), '<i8')
+                        resolution = float(element.get('resolution', 0))
+                        self._meta.append((name, meta_type, resolution))
+                        if element.get('absoluteTime'):
+                            self.absolute_times[name] = element.get('absoluteTime')
+                    elif tag == 'SensorMapping':
+                        self.sensor_mapping.append({key : int(element.get(key, default))
+                                                    for key, default in (('x', 0), ('y', 0), ('width', 0),
+                                                                         ('height', 0), ('xBinning', 1),
+                                                                         ('yBinning', 1))})
+                    continue
+
+                if tag == 'MetaBlock':
+                    in_meta = False
+                elif tag == 'Wavelength' and element.text:
+                    self.wavelengths = np.array(element.text.split(','), dtype=float)
+                elif tag == 'WavelengthError' and element.text and self.wavelengths is None:
+                    # pairs of wavelength,error
+                    self.wavelengths = np.array(element.text.split(','), dtype=float)[::2]
+                elif tag == 'Calibrations':
+                    break
+                element.clear()
+
+        if frame_block is None or not self.regions:
+            raise IOError('{:s} has no frame layout in its SPE 3.0 footer'.format(self.path))
+        if len(self.regions) > 1:
+            log.debug('{:d} regions of interest, only the first is read'.format(len(self.regions)))
+
+        self._pixel_dtype = np.dtype(SpeFile._pixel_format_map[frame_block['pixelFormat']])
+        self.frame_size = int(frame_block['size'])
+        self.frame_stride = int(frame_block['stride'])
+        self.header.NumFrames = int(frame_block['count'])
+        self.header.xdim = self.regions[0]['width']
+        self.header.ydim = self.regions[0]['height']
+
+    def _make_frame_dtype(self):
+        ''' Record dtype of one stored frame: first region as `data`, then per-frame metadata
+        '''
+
+        names = ['data']
+        formats = [(self._pixel_dtype, (self.header.ydim, self.header.xdim))]
+        offsets = [0]
+        offset = self.frame_size
+        for name, meta_type, resolution in self._meta:
+            names.append(name)
+            formats.append(meta_type)
+            offsets.append(offset)
+            offset += np.dtype(meta_type).itemsize
+
+        return np.dtype({'names' : names, 'formats' : formats, 'offsets' : offsets,
+                         'itemsize' : max(self.frame_stride, offset)})
+
     def _read(self):
         ''' Read the data segment of the file and create an appropriately-shaped numpy array
         Based on the header, the right datatype is selected and returned as a numpy array.  I took
@@ -126,27 +239,141 @@ class SpeFile(object):
         with open(self.path, mode='rb') as f:
             f.seek(4100) # Skip header (4100 bytes)
 
-            _count = self.header.xdim * self.header.ydim * self.header.NumFrames
-
-            self._data = np.fromfile(f, dtype=SpeFile._datatype_map[self.header.datatype], count=_count)
+            _records = np.fromfile(f, dtype=self._frame_dtype, count=self.header.NumFrames)
 
             # Also, apparently the ordering of the data corresponds to how it is stored by the shift register
             # Thus, it appears a little backwards...
-            self._data = self._data.reshape((self.header.NumFrames, self.header.ydim, self.header.xdim))
+            self._data = self._orient(_records['data'])
 
-            # Orient the structure so that it is indexed like [NumFrames][x, y]
-            self._data = np.rollaxis(self._data, 2, 1)
+            return self._data
 
-            # flip data
-            if all([self.reversed == True, self.adc == '100 KHz']):
-                pass
-            elif any([self.reversed == True, self.adc == '100 KHz']):
-                self._data = self._data[:, ::-1, :]
-                log.debug('flipped data because of nonstandard ADC setting ' + \
-                          'or reversed setting')
+    def _orient(self, raw):
+        ''' Turn stored (frames, y, x) data into [NumFrames][x, y] order, flipped if needed
+        Only views are taken, so this works on memory maps without copying them.
+        '''
+
+        # Orient the structure so that it is indexed like [NumFrames][x, y]
+        data = np.rollaxis(raw, 2, 1)
+
+        # flip data
+        if all([self.reversed == True, self.adc == '100 KHz']):
+            pass
+        elif any([self.reversed == True, self.adc == '100 KHz']):
+            data = data[:, ::-1, :]
+            log.debug('flipped data because of nonstandard ADC setting ' + \
+                      'or reversed setting')
+
+        return data
+
+    def _map(self):
+        ''' Memory map the data segment, indexed like `data` but read lazily
+        Nothing is read until a frame is indexed, and then only the pages holding that frame.
+        The map is read-only and is not cached, so it never holds the file open for long.
+        '''
 
+        if self._data is not None:
+            log.debug('using cached data')
             return self._data
 
+        return self._orient(self._map_records()['data'])
+
+    def _map_records(self):
+        ''' Memory map every stored frame, with its metadata, as one record
+        '''
+
+        return np.memmap(self.path, dtype=self._frame_dtype, mode='r', offset=4100,
+                         shape=(self.header.NumFrames,))
+
+    def frame(self, index):
+        ''' Map a single frame, indexed [x, y] like data[index]
+        Only the bytes of that frame are mapped, so reading one frame of a large kinetic series
+        costs one frame of memory.
+        '''
+
+        if self._data is not None:
+            return self._data[index]
+
+        num_frames = self.header.NumFrames
+        if index < 0:
+            index += num_frames
+        if not 0 <= index < num_frames:
+            raise IndexError('frame {:d} out of range for {:d} frames'.format(index, num_frames))
+
+        raw = np.memmap(self.path, dtype=self._frame_dtype, mode='r',
+                        offset=4100 + index * self._frame_dtype.itemsize, shape=(1,))
+
+        return self._orient(raw['data'])[0]
+
+    def iter_blocks(self, block_size=64, prefetch=False):
+        ''' Iterate over the data in blocks of up to `block_size` frames, yielding (start, block)
+        `start` is the index of the first frame in `block`, which is indexed like data[start:].
+        Frames are read with readinto into a buffer allocated once, so memory stays constant
+        however long the file, but each block is only valid until the next one is requested;
+        copy it to keep it.  With prefetch=True a second buffer is filled by a background thread
+        while the caller works on the current block.
+        '''
+
+        num_frames = self.header.NumFrames
+        buffers = [np.empty(block_size, dtype=self._frame_dtype) for each in range(2 if prefetch else 1)]
+
+        with open(self.path, mode='rb') as f:
+            f.seek(4100) # Skip header (4100 bytes)
+
+            def fill(start, buffer):
+                block = buffer[:min(block_size, num_frames - start)]
+                if f.readinto(block) != block.nbytes:
+                    raise IOError('{:s} ends before frame {:d}'.format(self.path, num_frames))
+                return block
+
+            starts = range(0, num_frames, block_size)
+            if not prefetch:
+                for start in starts:
+                    yield start, self._orient(fill(start, buffers[0])['data'])
+                return
+
+            with ThreadPoolExecutor(max_workers=1) as reader:
+                pending = reader.submit(fill, 0, buffers[0]) if num_frames else None
+                for count, start in enumerate(starts):
+                    block = pending.result()
+                    following = start + block_size
+                    if following < num_frames:
+                        pending = reader.submit(fill, following, buffers[(count + 1) % 2])
+                    yield start, self._orient(block['data'])
+
+    def iter_frames(self, block_size=64, prefetch=False):
+        ''' Iterate over single frames, indexed [x, y] like data[i]
+        Frames are views into the reused block buffer of iter_blocks, so copy any you keep.
+        '''
+
+        for start, block in self.iter_blocks(block_size, prefetch):
+            for frame in block:
+                yield frame
+
+    def __iter__(self):
+        return self.iter_frames()
+
+    @property
+    def frame_metadata(self):
+        ''' Per-frame metadata of SPE 3.0 files as raw arrays, keyed by footer name
+        Empty for WinSpec files, which have none.
+        '''
+
+        if not self._meta:
+            return {}
+        records = self._map_records()
+        return {name : np.array(records[name]) for name, meta_type, resolution in self._meta}
+
+    @property
+    def timestamps(self):
+        ''' Per-frame time stamps of SPE 3.0 files in seconds, keyed by event
+        E.g. 'ExposureStarted' and 'ExposureEnded', counted from the start of the acquisition;
+        the wall-clock time of that start, where LightField stored it, is in absolute_times.
+        '''
+
+        metadata = self.frame_metadata
+        return {name : metadata[name] / resolution
+                for name, meta_type, resolution in self._meta if resolution}
+
     @property
     def xaxis(self):
         if self._xaxis is not None:
@@ -183,36 +410,37 @@ class SpeFile(object):
     def _make_axes(self):
         '''Construct axes from calibration fields in header file
         '''
-        xcalib = self.header.xcalibration
-        ycalib = self.header.ycalibration
-
-        xcalib_valid = struct.unpack('?', xcalib.calib_valid)
+        region_wavelengths = None if self.wavelengths is None else self._region_wavelengths()
 
-        if xcalib_valid:
-            xcalib_order, = struct.unpack('>B', xcalib.polynom_order) # polynomial order
-            px = xcalib.polynom_coeff[:xcalib_order+1]
-            px = np.array(px[::-1]) # reverse coefficients to use numpy polyval
-            pixels = np.arange(1, self.header.xdim + 1)
-            px = np.polyval(px, pixels)
+        if region_wavelengths is not None:
+            px = region_wavelengths
         else:
-            px = np.arange(1, self.header.xdim + 1)
+            px = calibrated_axis(_calibration_polynomial(self.header.xcalibration), self.header.xdim)
 
-        ycalib_valid = struct.unpack('?', ycalib.calib_valid)
-
-        if ycalib_valid:
-            ycalib_order, = struct.unpack('>B', ycalib.polynom_order) # polynomial order
-            py = ycalib.polynom_coeff[:ycalib_order+1]
-            py = np.array(py[::-1]) # reverse coefficients to use numpy polyval
-            pixels = np.arange(1, self.header.ydim + 1)
-            py = np.polyval(py, pixels)
-        else:
-            py = np.arange(1, self.header.ydim + 1)
+        py = calibrated_axis(_calibration_polynomial(self.header.ycalibration), self.header.ydim)
 
         self._xaxis = px
         self._yaxis = py
 
         return px, py
 
+    def _region_wavelengths(self):
+        ''' Wavelengths of the first region of interest from the SPE 3.0 calibration
+        The footer lists either one wavelength per region pixel or one per sensor pixel; in
+        the latter case the region is cut out and binned using the sensor mapping.
+        '''
+
+        wavelengths = self.wavelengths
+        if len(wavelengths) != self.header.xdim and self.sensor_mapping:
+            mapping = self.sensor_mapping[0]
+            binning = max(mapping['xBinning'], 1)
+            wavelengths = wavelengths[mapping['x']:mapping['x'] + mapping['width']]
+            wavelengths = wavelengths[:len(wavelengths) // binning * binning].reshape(-1, binning).mean(axis=1)
+        if len(wavelengths) != self.header.xdim:
+            log.debug('wavelength calibration does not match the region, using the header calibration')
+            return None
+        return wavelengths
+
 
     ''' Data recorded in the file, returned as a numpy array. 
     
@@ -221,6 +449,12 @@ class SpeFile(object):
     '''
     data = property(fget=_read)
 
+    ''' Data recorded in the file, memory mapped instead of read.
+
+    Same indexing as `data`, but frames are only read from disk when they are indexed.
+    '''
+    mapped_data = property(fget=_map)
+
     def __str__(self):
         return 'SPE File \n\t{:d}x{:d} area, {:d} frames\n\tTaken on {:s}' \
             .format(self.header.xdim, self.header.ydim,
@@ -230,6 +464,242 @@ class SpeFile(object):
         return str(self)
 
 
+def _calibration_polynomial(calib):
+    ''' Polynomial coefficients of an AxisCalibration, lowest order first, or None if not valid
+    '''
+
+    calib_valid, = struct.unpack('?', calib.calib_valid)
+
+    if calib_valid:
+        calib_order, = struct.unpack('>B', calib.polynom_order) # polynomial order
+        return tuple(calib.polynom_coeff[:calib_order+1])
+
+    return None
+
+
+# Axes already built, shared between files, keyed by (polynomial coefficients, dimension)
+_axis_cache = {}
+
+
+def calibrated_axis(coefficients, dim):
+    ''' Pixels 1..dim mapped through the calibration polynomial `coefficients`
+    Coefficients are lowest order first, as stored in the header; None gives the pixel numbers.
+    The array is cached and shared by every file with the same calibration, so it is read-only.
+    '''
+
+    key = (None if coefficients is None else tuple(coefficients), dim)
+    axis = _axis_cache.get(key)
+
+    if axis is None:
+        pixels = np.arange(1, dim + 1)
+        if coefficients is None:
+            axis = pixels
+        else:
+            axis = np.polyval(np.array(key[0][::-1]), pixels) # reverse coefficients to use numpy polyval
+        axis.flags.writeable = False
+        _axis_cache[key] = axis
+
+    return axis
+
+
+def read_xaxis(name):
+    ''' The x axis of file `name`, reading only xdim and the x calibration from its header
+    SPE 3.0 files keep their calibration in the footer and are opened with SpeFile instead.
+    '''
+
+    with open(name, mode='rb') as f:
+        f.seek(Header.file_header_ver.offset)
+        version, = struct.unpack('<f', f.read(4))
+        if version >= 3:
+            return SpeFile(name).xaxis
+
+        f.seek(Header.xdim.offset)
+        xdim, = struct.unpack('<H', f.read(2))
+        f.seek(Header.xcalibration.offset)
+        xcalib = AxisCalibration.from_buffer_copy(f.read(ctypes.sizeof(AxisCalibration)))
+
+    return calibrated_axis(_calibration_polynomial(xcalib), xdim)
+
+
+def read_header(name):
+    ''' Read only the 4100-byte header of file `name`
+    '''
+
+    header = Header()
+    with open(name, mode='rb') as f:
+        if f.readinto(header) != ctypes.sizeof(Header):
+            raise IOError('{:s} is too short to be an SPE file'.format(name))
+    return header
+
+
+# Header fields kept in an SpeIndex
+_index_fields = ['date', 'ExperimentTimeLocal', 'exp_sec', 'NumFrames', 'xdim', 'ydim', 'gain',
+                 'ADCtype', 'ADCrate', 'file_header_ver', 'xcalibration']
+
+
+def _index_entries(records):
+    ''' SpeIndex entries, as plain JSON-friendly values, from decoded header records
+    '''
+
+    xcalib = records['xcalibration']
+    valid = (xcalib['calib_valid'] != 0).tolist()
+    orders = xcalib['polynom_order'].astype(int) + 1
+    coefficients = xcalib['polynom_coeff'].tolist()
+
+    columns = {'date' : [each.decode('ascii', 'replace') for each in records['date']],
+               'time' : [each.decode('ascii', 'replace') for each in records['ExperimentTimeLocal']],
+               'exp_sec' : records['exp_sec'].tolist(),
+               'NumFrames' : records['NumFrames'].tolist(),
+               'xdim' : records['xdim'].tolist(),
+               'ydim' : records['ydim'].tolist(),
+               'calibration' : [each[:order] if ok else None
+                               for each, order, ok in zip(coefficients, orders, valid)],
+               'gain' : records['gain'].tolist(),
+               'ADCtype' : records['ADCtype'].tolist(),
+               'ADCrate' : records['ADCrate'].tolist(),
+               'file_header_ver' : records['file_header_ver'].tolist()}
+
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+class SpeIndex(object):
+    ''' Header index of every SPE file in a directory, cached on disk.
+
+    Only the headers are read, several files at a time, and decoded together; the index is stored as JSON in
+    `directory`/.spe_index.json, or in `index_path` if given, e.g. SpeIndex.user_index_path(directory) for
+    read-only or archive directories.  An index that cannot be written is only kept in memory.
+    update() re-reads just the files whose size or mtime changed
+    since the last scan, so re-scanning a directory of hundreds of files is nearly free.
+    Each entry holds date, time, exp_sec, NumFrames, xdim, ydim, calibration (x polynomial
+    coefficients or None), gain, ADCtype, ADCrate and file_header_ver, or just 'error' for
+    files whose header could not be read.
+    For SPE 3.0 files these are the values LightField copied into the legacy header.
+    '''
+
+    index_name = '.spe_index.json'
+
+    def __init__(self, directory, workers=8, update=True, index_path=None):
+        self.directory = os.path.realpath(directory)
+        if index_path is None:
+            index_path = os.path.join(self.directory, SpeIndex.index_name)
+        self.index_path = index_path
+        self.workers = workers
+        self.entries = {}
+
+        try:
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            log.debug('no usable index in ' + self.directory)
+
+        if update:
+            self.update()
+
+    def update(self):
+        ''' Scan the directory, read the headers of new and changed files, drop deleted ones
+        Returns the names of the files that were (re)read.
+        '''
+
+        found = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.lower().endswith('.spe'):
+                stat = entry.stat()
+                found[entry.name] = (stat.st_mtime, stat.st_size)
+
+        stale = [name for name, (mtime, size) in found.items()
+                 if name not in self.entries
+                 or self.entries[name]['mtime'] != mtime or self.entries[name]['size'] != size]
+        removed = [name for name in self.entries if name not in found]
+
+        records, valid = read_headers([self.path(name) for name in stale], _index_fields, self.workers)
+
+        for name, fields, readable in zip(stale, _index_entries(records), valid):
+            if not readable:
+                # remembered, so that unreadable files are not retried until they change
+                fields = {'error' : 'unreadable SPE header'}
+            fields['mtime'], fields['size'] = found[name]
+            self.entries[name] = fields
+
+        for name in removed:
+            del self.entries[name]
+
+        if stale or removed:
+            self.save()
+
+        return stale
+
+    def save(self):
+        ''' Write the index to index_path, replacing the old one in a single step
+        Returns False, keeping the index in memory only, if it cannot be written.
+        '''
+
+        temporary = self.index_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(temporary, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temporary, self.index_path)
+        except OSError as error:
+            log.warning('unable to save the index of {:s}: {}'.format(self.directory, error))
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return False
+        return True
+
+    @staticmethod
+    def user_index_path(directory):
+        ''' Per-user index location for `directory`, under ~/.cache/spe_index
+        '''
+
+        directory = os.path.realpath(directory)
+        name = hashlib.sha1(directory.encode('utf-8')).hexdigest() + '.json'
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache, 'spe_index', name)
+
+    def query(self, predicate=None, **fields):
+        ''' Names of the files whose entries match, sorted
+        `fields` must be equal, e.g. NumFrames=1, and `predicate` is called with each entry,
+        e.g. query(lambda entry: entry['exp_sec'] < 1, NumFrames=1, date=SpeIndex.today()).
+        '''
+
+        return sorted(name for name, entry in self.entries.items()
+                      if 'error' not in entry and all(entry.get(key) == value for key, value in fields.items())
+                      and (predicate is None or predicate(entry)))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def open(self, name):
+        return SpeFile(self.path(name))
+
+    def xaxis(self, name):
+        ''' x axis of an indexed WinSpec file from the index alone, without touching the file
+        '''
+
+        entry = self.entries[name]
+        if entry.get('file_header_ver', 0) >= 3:
+            return self.open(name).xaxis
+        return calibrated_axis(entry['calibration'], entry['xdim'])
+
+    @staticmethod
+    def today():
+        ''' Today's date in the header's date format, e.g. 05Mar2019
+        '''
+
+        return time.strftime('%d%b%Y')
+
+    def __len__(self):
+        return len(self.query())
+
+    def __str__(self):
+        return 'SPE index of {:s}\n\t{:d} files'.format(self.directory, len(self))
+
+    def __repr__(self):
+        return str(self)
+
+
 # Lengths of arrays used in header
 HDRNAMEMAX = 120
 USERINFOMAX = 1000
@@ -431,6 +901,84 @@ Header._fields_ = [
     ('AvGain', spe_short),
     ('lastvalue', spe_short)]
 
+# Numpy description of the same structures, for decoding many headers at once
+
+# Map between ctypes scalars and numpy datatypes.  Single characters decode as uint8 codes
+# (a numpy 'S1' would drop a zero byte), arrays of characters as byte strings.
+_ctypes_dtype_map = {spe_byte : '<u1', spe_word : '<u2', spe_dword : '<u4', spe_char : '<u1',
+                     spe_short : '<i2', spe_long : '<i4', spe_float : '<f4', spe_double : '<f8'}
+
+
+def _ctypes_dtype(ctype):
+    ''' Numpy dtype with the same memory layout as the ctypes type `ctype`
+    '''
+
+    if issubclass(ctype, ctypes.Structure):
+        names = [name for name, field_type in ctype._fields_]
+        return np.dtype({'names' : names,
+                         'formats' : [_ctypes_dtype(field_type) for name, field_type in ctype._fields_],
+                         'offsets' : [getattr(ctype, name).offset for name in names],
+                         'itemsize' : ctypes.sizeof(ctype)})
+
+    if issubclass(ctype, ctypes.Array):
+        if ctype._type_ is spe_char:
+            return np.dtype('S{:d}'.format(ctype._length_))
+        return np.dtype((_ctypes_dtype(ctype._type_), (ctype._length_,)))
+
+    return np.dtype(_ctypes_dtype_map[ctype])
+
+
+# The full 4100-byte header, derived from Header._fields_
+HEADER_DTYPE = _ctypes_dtype(Header)
+
+
+def header_dtype(fields=None):
+    ''' Header dtype reduced to `fields`, still 4100 bytes per header
+    Decoding with a reduced dtype only converts the listed fields.
+    '''
+
+    if fields is None:
+        return HEADER_DTYPE
+
+    return np.dtype({'names' : list(fields),
+                     'formats' : [HEADER_DTYPE.fields[name][0] for name in fields],
+                     'offsets' : [HEADER_DTYPE.fields[name][1] for name in fields],
+                     'itemsize' : HEADER_DTYPE.itemsize})
+
+
+def decode_headers(buffer, fields=None):
+    ''' Decode a buffer of consecutive 4100-byte headers into a structured array, one row each
+    No data is copied; the rows are views of `buffer`.
+    '''
+
+    return np.frombuffer(buffer, dtype=header_dtype(fields))
+
+
+def read_headers(names, fields=None, workers=8):
+    ''' Read the headers of files `names` into one buffer and decode `fields` from all at once
+    Headers are read in parallel, straight into their slice of the buffer.  Returns the
+    structured array and a boolean array that is False where a file could not be read (its
+    row is then all zeros).
+    '''
+
+    size = HEADER_DTYPE.itemsize
+    buffer = bytearray(size * len(names))
+    view = memoryview(buffer)
+    valid = np.zeros(len(names), dtype=bool)
+
+    def read(index):
+        try:
+            with open(names[index], mode='rb') as f:
+                valid[index] = f.readinto(view[index * size:(index + 1) * size]) == size
+        except IOError as error:
+            log.debug('skipping {:s}: {:s}'.format(names[index], str(error)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(read, range(len(names))))
+
+    return decode_headers(buffer, fields), valid
+
+
 # ###test = SpeFile('Bi-cell4-ruby7.SPE')
 # ###print(test)
 # ###print(test.header.ExperimentTimeUTC)
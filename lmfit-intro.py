@@ -6,8 +6,7 @@ import pyqtgraph as pg
 spectra = SpeFile('Bi-cell4-ruby7.SPE')
 
 x = spectra.xaxis
-y = spectra.data[0]
-y.resize(1340,)
+y = np.array(spectra.frame(0)).reshape(1340)
 
 full_max_index = np.argmax(y)
 roi_min = full_max_index - 150